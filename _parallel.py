@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Process-pool and shared-memory helpers behind the workers= arguments of
+numbertheory and graphtheory.
+"""
+import concurrent.futures
+from multiprocessing import shared_memory
+import os
+import numpy as np
+
+def pool(workers):
+    """executor for a workers= argument as (executor,owned): None or 1 runs
+       serially (executor None), an int starts a process pool of that size
+       which the caller must shut down, an Executor instance is used as is
+    """
+    if workers is None or workers == 1:
+        return None,False
+    if isinstance(workers,concurrent.futures.Executor):
+        return workers,False
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers),True
+
+def pool_size(workers)->int:
+    """number of processes to split work for: the workers= count itself, or
+       the CPU count for an Executor instance
+    """
+    if isinstance(workers,concurrent.futures.Executor):
+        return os.cpu_count() or 1
+    return max(int(workers),1)
+
+def split_range(lo:int,hi:int,parts:int,align:int=1):
+    """[lo,hi) cut into at most parts consecutive ranges whose lengths are
+       multiples of align (except the last)
+    """
+    step = -(-max(-(-(hi-lo)//parts),1)//align)*align
+    return [(s,min(s+step,hi)) for s in range(lo,hi,step)]
+
+def shared_array(shape,dtype):
+    """numpy array in a fresh shared memory block, as (shm,array,spec) where
+       spec lets a worker process attach to it with attach_array
+    """
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape))*dtype.itemsize,1)
+    shm = shared_memory.SharedMemory(create=True,size=size)
+    return shm,np.ndarray(shape,dtype=dtype,buffer=shm.buf),\
+           (shm.name,tuple(shape),dtype.str)
+
+def shared_copy(arr):
+    """shared_array holding a copy of arr"""
+    shm,shared,spec = shared_array(arr.shape,arr.dtype)
+    shared[...] = arr
+    return shm,shared,spec
+
+def attach_array(spec):
+    """(shm,array) for a shared_array spec, or (None,memmap) for an
+       ('npy',path) or ('npy',path,mode) spec naming a .npy file
+    """
+    if spec[0] == 'npy':
+        return None,np.load(spec[1],mmap_mode=spec[2] if len(spec) > 2 else 'r+')
+    name,shape,dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm,np.ndarray(shape,dtype=dtype,buffer=shm.buf)
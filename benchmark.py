@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hot paths of numbertheory and graphtheory.
+
+Every case runs over a ladder of input sizes on seeded synthetic inputs,
+so two runs on the same machine measure the same work. A case is timed as
+the best of --repeat runs, each on a freshly built input so that cached
+graph results do not hide the cold cost; a second call on the same input
+gives the warm time. A last fresh run under tracemalloc gives the peak
+allocation (numpy buffers included). Results go to a JSON file that
+--compare can diff against an earlier run.
+
+    python benchmark.py                      # default sizes
+    python benchmark.py --quick --only graph # small sizes, graph cases
+    python benchmark.py --full --out new.json --compare old.json
+    python benchmark.py --check              # correctness checks only
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+import graphtheory as gt
+import numbertheory as nt
+
+SEED = 20161012
+
+# name -> (setup(size,rng) returning the argument, run(argument), sizes by
+# level); setup is not timed
+CASES = {}
+
+def case(name,quick,default,full):
+    def register(setup_run):
+        CASES[name] = (setup_run,{'quick':quick,'default':default,
+                                  'full':full})
+        return setup_run
+    return register
+
+def random_prime(bits:int,rng:random.Random)->int:
+    while True:
+        p = rng.getrandbits(bits) | (1 << (bits-1)) | 1
+        if nt.is_probable_prime(p):
+            return p
+
+def grid_costs(n:int,seed:int):
+    return np.random.default_rng(seed).integers(1,1000,(n,n))
+
+def potential_graph(V:int,E:int,seed:int,acyclic:bool=False):
+    '''random graph with negative edges but no negative cycle: weights
+    w(u,v) = c + h[u]-h[v] with c >= 0, so every cycle has weight >= 0
+    '''
+    rng = np.random.default_rng(seed)
+    src,dst = rng.integers(0,V,E),rng.integers(0,V,E)
+    keep = src != dst
+    src,dst = src[keep],dst[keep]
+    if acyclic:
+        src,dst = np.minimum(src,dst),np.maximum(src,dst)
+    # parallel edges would be merged by summing weights, breaking the bound
+    src,dst = np.unique(np.stack((src,dst)),axis=1)
+    h = rng.integers(-50,50,V)
+    weights = rng.integers(0,20,len(src))+h[src]-h[dst]
+    return gt.directed_graph.from_edge_arrays(src,dst,weights,
+                                              nodes=range(V))
+
+# --- numbertheory ------------------------------------------------------------
+
+@case('sieve',[10**5,10**6],[10**6,10**7],[10**7,10**8])
+def _(size,rng):
+    return size,lambda N: nt.sieve(N,asarray=True)
+
+@case('is_probable_prime/64bit',[1000],[10000],[100000])
+def _(size,rng):
+    values = [rng.getrandbits(64) | 1 for _ in range(size)]
+    return values,lambda v: [nt.is_probable_prime(x) for x in v]
+
+@case('is_probable_prime/128bit',[1000],[10000],[100000])
+def _(size,rng):
+    values = [rng.getrandbits(128) | 1 for _ in range(size)]
+    return values,lambda v: [nt.is_probable_prime(x) for x in v]
+
+@case('is_probable_prime_many/64bit',[10**4],[10**5],[10**6])
+def _(size,rng):
+    values = np.array([rng.getrandbits(63) | 1 for _ in range(size)],
+                      dtype=np.int64)
+    return values,nt.is_probable_prime_many
+
+@case('PrimeFactors/semiprime_bits',[32,40],[32,40,48],[40,48,56,64])
+def _(size,rng):
+    # 20 semiprimes with two factors of size/2 bits each
+    values = [random_prime(size//2,rng)*random_prime(size-size//2,rng)
+              for _ in range(20)]
+    return values,lambda v: [nt.PrimeFactors(x) for x in v]
+
+@case('assistedPF/factorize_many',[10**5],[10**6],[10**6,10**7])
+def _(size,rng):
+    values = np.arange(2,size)
+    return values,lambda v: nt.assistedPF(size).factorize_many(v,
+                                                               asarrays=True)
+
+# --- graphtheory -------------------------------------------------------------
+
+@case('from_grid/4-neighbour',[100],[100,300],[300,1000])
+def _(size,rng):
+    costs = grid_costs(size,rng.randrange(2**32))
+    return costs,gt.directed_graph.from_grid
+
+@case('shortest_path/grid_dag',[100],[100,300],[300,1000])
+def _(size,rng):
+    # the down/right grid of the example: acyclic, dagpath
+    graph = gt.directed_graph.from_grid(grid_costs(size,rng.randrange(2**32)),
+                                        neighbours=[(1,0),(0,1)])
+    target = (size-1,size-1)
+    return graph,lambda g: g.shortest_path((0,0),target)
+
+@case('shortest_path/grid_positive_cyclic',[100],[100,300],[300,1000])
+def _(size,rng):
+    # 4-neighbour grid: cyclic with positive weights, dijkstra
+    graph = gt.directed_graph.from_grid(grid_costs(size,rng.randrange(2**32)))
+    target = (size-1,size-1)
+    return graph,lambda g: g.shortest_path((0,0),target)
+
+@case('shortest_path/negative_cyclic',[10**3],[10**3,10**4],[10**4,10**5])
+def _(size,rng):
+    graph = potential_graph(size,4*size,rng.randrange(2**32))
+    graph.freeze()
+    targets = list(range(0,size,max(1,size//100)))
+    return graph,lambda g: g.shortest_path(0,targets)
+
+@case('shortest_path/negative_dag',[10**3],[10**3,10**4],[10**4,10**5])
+def _(size,rng):
+    graph = potential_graph(size,4*size,rng.randrange(2**32),acyclic=True)
+    targets = list(range(0,size,max(1,size//100)))
+    return graph,lambda g: g.shortest_path(0,targets)
+
+@case('distance_matrix/grid',[30],[30,60],[60,100])
+def _(size,rng):
+    graph = gt.directed_graph.from_grid(grid_costs(size,rng.randrange(2**32)))
+    sources = graph.nodes()[::size]
+    return graph,lambda g: g.distance_matrix(sources)
+
+@case('add_edge/stream_dag',[10**3],[10**4],[10**5])
+def _(size,rng):
+    edges = [tuple(sorted(rng.sample(range(size),2))) for _ in range(4*size)]
+    def run(edges):
+        graph = gt.directed_graph({i:{} for i in range(size)})
+        graph.Topsort()
+        for k,(a,b) in enumerate(edges):
+            graph.add_edge(a,b)
+            if k%100 == 0:
+                graph.shortest_path(a,b)
+    return edges,run
+
+# --- checks ------------------------------------------------------------------
+
+# regression checks of results, run by --check; each raises AssertionError
+CHECKS = []
+
+def check(f):
+    CHECKS.append(f)
+    return f
+
+@check
+def astar_grid_8_neighbour():
+    # a diagonal step covers manhattan distance 2 for one cell's cost, so the
+    # built-in metrics must not just be scaled by the smallest weight; cheap
+    # near-uniform costs make the diagonal shortcuts matter
+    for seed in range(100):
+        costs = np.random.default_rng(seed).integers(1,3,(12,12))
+        for graph in (gt.directed_graph.from_grid(costs,8),
+                      gt.directed_graph.from_grid(costs,8).freeze()):
+            best = graph.shortest_path((0,0),(11,11),method='dijkstra')[0]
+            for metric in ('manhattan','euclidean','chebyshev'):
+                d,_ = graph.shortest_path((0,0),(11,11),method='astar',
+                                          heuristic=metric)
+                assert d == best,(seed,type(graph).__name__,metric,d,best)
+
+# --- driver ------------------------------------------------------------------
+
+def measure(name:str,size:int,repeat:int)->dict:
+    # each repeat gets a fresh argument from the same seed, so the cached
+    # isdag/Topsort/scc/freeze results of one run do not leak into the next;
+    # the timed first call is the cold cost, a second call on the same
+    # argument the warm one
+    setup = CASES[name][0]
+    def fresh():
+        return setup(size,random.Random(f'{SEED}/{name}/{size}'))
+    cold,warm = [],[]
+    for _ in range(repeat):
+        argument,run = fresh()
+        for times in (cold,warm):
+            start = time.perf_counter()
+            run(argument)
+            times.append(time.perf_counter()-start)
+    argument,run = fresh()
+    tracemalloc.start()
+    try:
+        run(argument)
+        _,peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'name':name,'size':size,'seconds':min(cold),
+            'mean_seconds':sum(cold)/len(cold),'warm_seconds':min(warm),
+            'repeat':repeat,'peak_bytes':peak}
+
+def compare(results:list,baseline:str):
+    with open(baseline) as f:
+        old = {(r['name'],r['size']):r for r in json.load(f)['results']}
+    print('\n%-40s %10s %10s %10s' % ('case','size','time x','peak x'))
+    for r in results:
+        o = old.get((r['name'],r['size']))
+        if o is None:
+            continue
+        print('%-40s %10d %10.2f %10.2f' % (r['name'],r['size'],
+              r['seconds']/max(o['seconds'],1e-12),
+              r['peak_bytes']/max(o['peak_bytes'],1)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    level = parser.add_mutually_exclusive_group()
+    level.add_argument('--quick',dest='level',action='store_const',
+                       const='quick',help='small sizes, a smoke run')
+    level.add_argument('--full',dest='level',action='store_const',
+                       const='full',help='the largest sizes (sieve to 1e8, '
+                       '1000x1000 grids)')
+    parser.add_argument('--only',default='',
+                        help='run the cases whose name contains this')
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--out',default='benchmark.json')
+    parser.add_argument('--compare',help='earlier JSON output to diff with')
+    parser.add_argument('--check',action='store_true',
+                        help='run the correctness checks instead of timing')
+    args = parser.parse_args(argv)
+    if args.check:
+        for f in CHECKS:
+            f()
+            print('%-40s ok' % f.__name__)
+        return
+    level = args.level or 'default'
+    results = []
+    for name,(_,sizes) in CASES.items():
+        if args.only not in name:
+            continue
+        for size in sizes[level]:
+            r = measure(name,size,args.repeat)
+            results.append(r)
+            print('%-40s %10d %10.4fs %10.4fs %10.1f MiB' % (name,size,
+                  r['seconds'],r['warm_seconds'],r['peak_bytes']/2**20))
+    meta = {'python':sys.version.split()[0],'numpy':np.__version__,
+            'platform':platform.platform(),'machine':platform.machine(),
+            'level':level,'seed':SEED,
+            'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(args.out,'w') as f:
+        json.dump({'meta':meta,'results':results},f,indent=1)
+    if args.compare:
+        compare(results,args.compare)
+
+if __name__ == '__main__':
+    main()
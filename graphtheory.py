@@ -6,8 +6,347 @@ Created on Wed Oct 12 21:46:22 2016
 """
 
 from numbers import Number
+import collections
+import contextlib
+import contextvars
+import heapq
+import math
+import os
+import pickle
+import time
 import numpy as np
 import copy as copy
+import itertools
+import _parallel
+
+_HOLE = object() # placeholder for a deleted node in directed_graph.__nodes
+
+_stats_hook = None # called with a query_stats per shortest_path, if set
+# query_stats of the shortest_path call being recorded in this thread/task
+_query = contextvars.ContextVar('_query',default=None)
+
+class query_stats:
+    '''record of one shortest_path call, passed to the stats hook.
+    method := the engine used, after 'auto' is resolved
+    counts := work reported by the engines: nodes_settled, edges_relaxed
+    (distance improvements), heap_pushes, heap_pops, bf_passes,
+    components, and isdag_hits/dfslog_hits for cached results reused
+    cache := which cached results existed when the query started
+    phases := seconds spent in dispatch ('auto' selection), topsort,
+    search and paths (reconstruction); seconds is the total
+    '''
+    def __init__(self,graph,method,cache):
+        self.graph = type(graph).__name__
+        self.method = method
+        self.cache = cache
+        self.counts = collections.Counter()
+        self.phases = dict.fromkeys(('dispatch','topsort','search','paths'),0.)
+        self.seconds = 0.
+
+    def count(self,**counts):
+        self.counts.update(counts)
+
+    def phase(self,name,start):
+        self.phases[name] += time.perf_counter()-start
+
+    def __repr__(self):
+        return 'query_stats(%s %s, %.6fs, %s)' % (self.graph,self.method,
+                                                  self.seconds,
+                                                  dict(self.counts))
+
+class search_stats:
+    '''stats hook keeping every query_stats in self.queries'''
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self,query):
+        self.queries.append(query)
+
+    def totals(self):
+        '''counts and phase times summed over the queries, and the number
+        of queries per method
+        '''
+        counts,phases = collections.Counter(),collections.Counter()
+        for q in self.queries:
+            counts.update(q.counts)
+            phases.update(q.phases)
+        return {'queries':len(self.queries),
+                'methods':dict(collections.Counter(q.method 
+                                                   for q in self.queries)),
+                'counts':dict(counts),'phases':dict(phases),
+                'seconds':sum(q.seconds for q in self.queries)}
+
+def set_stats_hook(hook):
+    '''hook(query_stats) is then called after every shortest_path query;
+    None (the default) turns recording off, leaving one check per
+    query and per engine call. Returns the previous hook
+    '''
+    global _stats_hook
+    previous,_stats_hook = _stats_hook,hook
+    return previous
+
+@contextlib.contextmanager
+def collect_stats():
+    '''with collect_stats() as stats: ... records the shortest_path calls
+    made inside the block into a search_stats
+    '''
+    stats = search_stats()
+    previous = set_stats_hook(stats)
+    try:
+        yield stats
+    finally:
+        set_stats_hook(previous)
+
+def _recorded(graph,search,cache,node_start,node_fin,method,heuristic):
+    '''search(...) as a recorded query; a query made while another is
+    being recorded adds to that one
+    '''
+    if _query.get() is not None:
+        return search(node_start,node_fin,method,heuristic)
+    query = query_stats(graph,method,cache)
+    token = _query.set(query)
+    start = time.perf_counter()
+    try:
+        return search(node_start,node_fin,method,heuristic)
+    finally:
+        _query.reset(token)
+        query.seconds = time.perf_counter()-start
+        query.phases['search'] = max(0.,query.seconds-query.phases['dispatch']
+                                     -query.phases['topsort']
+                                     -query.phases['paths'])
+        _stats_hook(query)
+
+def _trace(pred:dict,node):
+    '''path from the search root to node by following predecessors'''
+    record = _query.get()
+    if record is not None:
+        start = time.perf_counter()
+    path = [node]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+    path.reverse()
+    if record is not None:
+        record.phase('paths',start)
+    return path
+
+def _dijkstra(succ,start,targets=None,max_dist=np.inf,max_nodes=None):
+    '''single-source Dijkstra over arbitrary node keys; succ(u) iterates
+    the (neighbour,weight) out-edges of u. Improved nodes are simply pushed
+    again and stale heap entries skipped when popped (lazy deletion), so
+    the frontier only ever holds nodes actually reached. The search stops
+    once all targets are settled, the next distance exceeds max_dist or
+    max_nodes nodes are settled. Returns (dist,pred) for the settled nodes
+    '''
+    best,parent = {start:0},{start:None}
+    dist,pred = {},{}
+    remaining = None if targets is None else set(targets)
+    tie = itertools.count() # heap entries never compare node labels
+    heap = [(0,next(tie),start)]
+    while heap:
+        d,_,u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        if d > max_dist:
+            break
+        dist[u],pred[u] = d,parent[u]
+        if remaining is not None:
+            remaining.discard(u)
+            if not remaining:
+                break
+        if max_nodes is not None and len(dist) >= max_nodes:
+            break
+        for v,w in succ(u):
+            nd = d+w
+            if nd < best.get(v,np.inf) and v not in dist:
+                best[v],parent[v] = nd,u
+                heapq.heappush(heap,(nd,next(tie),v))
+    record = _query.get()
+    if record is not None:
+        pushes = next(tie)
+        record.count(nodes_settled=len(dist),edges_relaxed=pushes-1,
+                     heap_pushes=pushes,heap_pops=pushes-len(heap))
+    return dist,pred
+
+class NegativeCycleError(Exception):
+    '''raised by the negative-weight engines; cycle lists the nodes of a
+    negative cycle in edge order (the edge back to the first node closes it)
+    '''
+    def __init__(self,cycle):
+        Exception.__init__(self,'Negative cycle found')
+        self.cycle = cycle
+
+def _parent_cycle(pred:dict):
+    '''a cycle of the predecessor graph in edge order, None if it is a
+    forest. Each node is walked over once, so this is O(V); any such cycle
+    left behind by edge relaxations has negative weight
+    '''
+    walk_of = {}
+    for walk,root in enumerate(pred):
+        path,y = [],root
+        while y is not None and y not in walk_of:
+            walk_of[y] = walk
+            path.append(y)
+            y = pred[y]
+        if y is not None and walk_of[y] == walk:
+            cycle = path[path.index(y):]
+            cycle.reverse()
+            return cycle
+    return None
+
+def _spfa(succ,start,V:int):
+    '''queue-based Bellman-Ford (SPFA) from start over arbitrary node keys;
+    succ(u) iterates the (neighbour,weight) out-edges of u and V is the
+    number of nodes. A node whose path has V edges, and every V-th
+    relaxation, triggers a search for a cycle in the predecessor graph,
+    raising NegativeCycleError with it. Returns (dist,pred) for the
+    reachable nodes
+    '''
+    dist,pred,length = {start:0},{start:None},{start:0}
+    queue,queued = collections.deque([start]),{start}
+    relaxations = 0
+    while queue:
+        u = queue.popleft()
+        queued.discard(u)
+        du = dist[u]
+        for v,w in succ(u):
+            if du+w < dist.get(v,np.inf):
+                dist[v],pred[v],length[v] = du+w,u,length[u]+1
+                relaxations += 1
+                if length[v] >= V or relaxations%V == 0:
+                    cycle = _parent_cycle(pred)
+                    if cycle is not None:
+                        raise NegativeCycleError(cycle)
+                if v not in queued:
+                    queue.append(v)
+                    queued.add(v)
+    record = _query.get()
+    if record is not None:
+        record.count(nodes_settled=len(dist),edges_relaxed=relaxations)
+    return dist,pred
+
+def _bidirectional(succ,predecessors,start,target):
+    '''point-to-point Dijkstra grown from both ends at once: forwards
+    along succ(u) from start and backwards along predecessors(u) from
+    target, always expanding the side with the smaller tentative distance.
+    Stops once the two heap minima add up to no less than the best
+    start-target path seen. Returns (dist,path), (inf,[]) if unreachable
+    '''
+    if start == target:
+        return 0,[start]
+    tie = itertools.count()
+    dist = ({start:0},{target:0})
+    parent = ({start:None},{target:None})
+    done = (set(),set())
+    heaps = ([(0,next(tie),start)],[(0,next(tie),target)])
+    adjacency = (succ,predecessors)
+    best,meet = np.inf,None
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0]+heaps[1][0][0] >= best:
+            break
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        d,_,u = heapq.heappop(heaps[side])
+        if u in done[side]:
+            continue
+        done[side].add(u)
+        mine,other = dist[side],dist[1-side]
+        for v,w in adjacency[side](u):
+            if d+w < mine.get(v,np.inf):
+                mine[v] = d+w
+                parent[side][v] = u
+                heapq.heappush(heaps[side],(d+w,next(tie),v))
+            if v in other and mine[v]+other[v] < best:
+                best,meet = mine[v]+other[v],v
+    record = _query.get()
+    if record is not None:
+        pushes = next(tie)
+        record.count(nodes_settled=len(done[0])+len(done[1]),
+                     edges_relaxed=pushes-2,heap_pushes=pushes,
+                     heap_pops=pushes-len(heaps[0])-len(heaps[1]))
+    if meet is None:
+        return np.inf,[]
+    backwards = _trace(parent[1],meet)
+    backwards.reverse()
+    return best,_trace(parent[0],meet)+backwards[1:]
+
+def _astar(succ,start,target,heuristic):
+    '''A* search from start to target; heuristic(u) must never
+    overestimate the remaining distance from u. Nodes are reopened if a
+    shorter route turns up, so the heuristic need not be consistent.
+    Returns (dist,path), (inf,[]) if unreachable
+    '''
+    tie = itertools.count()
+    g,parent,closed = {start:0},{start:None},set()
+    heap = [(heuristic(start),next(tie),start)]
+    found = None
+    while heap:
+        _,_,u = heapq.heappop(heap)
+        if u in closed:
+            continue
+        if u == target:
+            found = u
+            break
+        closed.add(u)
+        for v,w in succ(u):
+            if g[u]+w < g.get(v,np.inf):
+                g[v],parent[v] = g[u]+w,u
+                closed.discard(v)
+                heapq.heappush(heap,(g[v]+heuristic(v),next(tie),v))
+    record = _query.get()
+    if record is not None:
+        pushes = next(tie)
+        record.count(nodes_settled=len(closed),edges_relaxed=pushes-1,
+                     heap_pushes=pushes,heap_pops=pushes-len(heap))
+    if found is None:
+        return np.inf,[]
+    return g[found],_trace(parent,found)
+
+def manhattan(node,target):
+    '''L1 distance between tuple-labelled grid nodes'''
+    return sum(abs(a-b) for a,b in zip(node,target))
+
+def euclidean(node,target):
+    '''L2 distance between tuple-labelled grid nodes'''
+    return math.sqrt(sum((a-b)**2 for a,b in zip(node,target)))
+
+def chebyshev(node,target):
+    '''L-infinity distance between tuple-labelled grid nodes'''
+    return max(abs(a-b) for a,b in zip(node,target))
+
+_HEURISTICS = {'manhattan':manhattan,'euclidean':euclidean,
+               'chebyshev':chebyshev}
+
+def _metric_scale(metric,edges):
+    '''largest s with s*metric(u,v) <= w for every edge (u,v,w) on labels.
+    By the triangle inequality s*metric(u,t) is then at most the length of
+    any path from u to t, on any graph; 0 if no edge has metric(u,v) > 0
+    '''
+    scale = np.inf
+    for u,v,w in edges:
+        m = metric(u,v)
+        if m > 0 and w < scale*m:
+            scale = w/m
+    return 0 if scale == np.inf else scale
+
+def _point_to_point(graph,node_start,node_fin,method,heuristic,succ,
+                    predecessors,label=lambda x:x):
+    '''shared 'bidirectional'/'astar' handling of shortest_path: one
+    search per target, heuristic given as a callable h(node,target) or the
+    name of a grid metric, scaled by graph.metric_scale() so that it never
+    overestimates
+    '''
+    if graph.min_weight() < 0:
+        raise Exception(method + ' search needs non-negative edge weights')
+    if method == 'bidirectional':
+        return [_bidirectional(succ,predecessors,node_start,nf)
+                for nf in node_fin]
+    if heuristic is None:
+        raise Exception('astar search needs a heuristic')
+    if isinstance(heuristic,str):
+        metric,scale = _HEURISTICS[heuristic],graph.metric_scale(heuristic)
+        heuristic = lambda u,t: scale*metric(u,t)
+    return [_astar(succ,node_start,nf,
+                   lambda u: heuristic(label(u),label(nf)))
+            for nf in node_fin]
 
 class directed_graph:
     '''Directed finite graph represented as an adjacency list.
@@ -20,15 +359,22 @@ class directed_graph:
         modify it into a standard input format - send explicit object
         by using dict.copy() if this is to be avoided.
         '''
-        self.__nodes = []
+        self.__nodes = [] # may hold _HOLE where delnodes removed a node
+        self.__nodepos = {} # node -> index in self.__nodes
+        self.__holes = 0
         self.__nodetoN = dict()
+        self.__nodetoP = dict() # in-edges {node:{pred:weight}}, kept in step
         self.__accepted_leaftypes = [Number] # consider including lists
         self.__isdag = None # is the graph acyclic
         self.__istree = None # is the graph a tree
         self.__ispositive = None # are all edge weights positive
         self.__istopsorted = False # if the graph is acyclic, is self.__nodes in
                              # topological order
-        self.__dfslog = {}
+        self.__dfslog = None # (nodes,entry times,exit times) of the last DFS
+        self.__csr = None # frozen compact copy, see freeze()
+        self.__minweight = None # smallest edge weight
+        self.__metricscale = {} # grid metric name -> metric_scale()
+        self.__chindex = None # contraction hierarchy, see build_query_index()
         # multiple-edges between two nodes are currently represented using weightings
         # on edges, viz. the leaf n represents n edges. The class currently does
         # not support multiple, weighted edges - not that I can conceive of an application
@@ -49,6 +395,7 @@ class directed_graph:
         need to be supplied instead.
         Note that in either case the entire input must be consistent in format.
         '''
+        incremental = self.__isdag and self.__istopsorted
         for key,val in node2N.items():
             if key in self.__nodetoN.keys():
                 raise Exception('Error: trying to add a node that exists - ' + \
@@ -63,18 +410,24 @@ class directed_graph:
                 self.__nodetoN[key] = val.copy() 
             else:
                 raise Exception('Invalid dictionary used to define graph')
-            
-        self.__nodes.extend(node2N.keys())
+            self.__nodetoP.setdefault(key,{})
+            for key2,val2 in self.__nodetoN[key].items():
+                self.__nodetoP.setdefault(key2,{})[key] = val2
+        for key in node2N.keys():
+            self.__nodepos[key] = len(self.__nodes)
+            self.__nodes.append(key)
+
         if validate:
             self.validate()
-            
-        # now that the graph structure has changed, the following must be recomputed
-        # on demand
-        self.__isdag = None
-        self.__istopsorted = False
-        self.__istree = None
+        if incremental:
+            self.__order_added(node2N.keys())
+        else:
+            # now that the graph structure has changed, the following must be
+            # recomputed on demand
+            self.__isdag = None
+            self.__istopsorted = False
         self.__ispositive = None
-        self.__dfslog = {}
+        self.__invalidate()
 
         #symmetrize
 #        try:
@@ -85,16 +438,42 @@ class directed_graph:
 #            raise Exception('Invalid dictionary used to define/modify graph')
 
     def add_edge(self,node1,node2,weight=1):
-        self.__nodetoN[node1][node2] = weight + self.__nodetoN[node1].get(node2,0)
-        # now that the graph structure has changed, the following must be recomputed
-        # on demand
-        self.__isdag = None
-        self.__istopsorted = False
-        self.__istree = None
-        if weight < 0 and self.__ispositive: 
-            self.__ispositive = False  # not anymore
-        self.__dfslog = {}
+        ''' add an edge (or weight to an existing one). If the graph is known
+            to be acyclic and topologically sorted, the order is repaired in
+            place and a cycle is reported on insertion, see __insert_order()
+        '''
+        self.add_edges([(node1,node2,weight)])
         # self.__nodetoN[node2][node1] = self.__nodetoN[node1][node2]
+
+    def add_edges(self,edges):
+        ''' add_edge for an iterable of (node1,node2) or (node1,node2,weight)
+            tuples, with the cached results dropped once for the batch
+        '''
+        nodetoN = self.__nodetoN
+        try:
+            for edge in edges:
+                node1,node2 = edge[0],edge[1]
+                weight = edge[2] if len(edge) > 2 else 1
+                new = node2 not in nodetoN[node1]
+                nodetoN[node1][node2] = weight + nodetoN[node1].get(node2,0)
+                self.__nodetoP.setdefault(node2,{})[node1] = \
+                    nodetoN[node1][node2]
+                if weight < 0 and self.__ispositive: 
+                    self.__ispositive = False  # not anymore
+                if not new or self.__isdag is False:
+                    continue # same edge set, or still cyclic
+                if self.__isdag and self.__istopsorted and node1 != node2 and \
+                   node2 in self.__nodepos:
+                    if not self.__insert_order(node1,node2):
+                        self.__isdag = False
+                        self.__istopsorted = False
+                else:
+                    self.__isdag = None
+                    self.__istopsorted = False
+        finally:
+            # now that the graph structure has changed, the following must be
+            # recomputed on demand - also when an edge in the batch raised
+            self.__invalidate()
         
     def delete_edge(self,node1,node2,weight=1):
         try:
@@ -102,17 +481,18 @@ class directed_graph:
         except KeyError:
             raise Exception('Cannot delete a non-existent edge')
         # self.__nodetoN[node2][node1] = self.__nodetoN[node1][node2]
-        if abs(self.__nodetoN[node2][node1]) < 1e-12:
-            del self.__nodetoN[node2][node1]
-            # del self.__nodetoN[node1][node2]
+        self.__nodetoP[node2][node1] = self.__nodetoN[node1][node2]
+        if abs(self.__nodetoN[node1][node2]) < 1e-12:
+            del self.__nodetoN[node1][node2]
+            del self.__nodetoP[node2][node1]
         # now that the graph structure has changed, the following must be recomputed
         # on demand
-        self.__isdag = None # <--- in case graph has one cycle which is broken
+        if self.__isdag is False:
+            self.__isdag = None # <--- in case graph has one cycle which is broken
         # self.__istopsorted = False <-- top sorting remains valid 
-        self.__istree = None # <--- 
         if weight < 0 and self.__ispositive: 
             self.__ispositive = False  # not anymore
-        self.__dfslog = {}
+        self.__invalidate()
             
     def validate(self):
         for key,val in self.__nodetoN.items():
@@ -120,14 +500,170 @@ class directed_graph:
                 raise Exception('Invalid input used to define/modify graph')
             if key in val.keys():
                 del val[key] # self-loops are removed
+                del self.__nodetoP[key][key]
             for key2,val2 in val.items():
-                if key2 not in self.__nodes or not isinstance(val2,Number):
+                if key2 not in self.__nodepos or not isinstance(val2,Number):
                     raise Exception('Invalid dictionary used to define graph') 
-        if set(self.__nodetoN.keys()) != set(self.__nodes):
+        if set(self.__nodetoN.keys()) != set(self.__nodepos) or \
+           set(self.__nodetoP.keys()) != set(self.__nodepos):
             raise Exception('Internal mismatch between node and neighbour lists')    
 #                elif self.__nodetoN[key2][key] != val2:
 #                    raise Exception('Node neighbours are not defined symmetrically')
         
+    def __invalidate(self):
+        '''drop the results derived from the edge set; isdag, the
+        topological order and ispositive are kept up to date by the callers
+        '''
+        self.__istree = None
+        self.__dfslog = None
+        self.__csr = None
+        self.__minweight = None
+        self.__metricscale = {}
+        self.__chindex = None
+
+    @classmethod
+    def __from_ids(cls,labels,src,dst,weights):
+        '''graph on the node list labels from id-level edge arrays, in one
+        pass: parallel edges are merged by summing their weights and the
+        result is laid out as CSR for __from_csr
+        '''
+        labels = list(labels)
+        V = len(labels)
+        key = np.asarray(src,dtype=np.int64)*V + np.asarray(dst,dtype=np.int64)
+        order = np.argsort(key,kind='stable')
+        key,weights = key[order],np.asarray(weights)[order]
+        if len(key):
+            starts = np.flatnonzero(np.r_[True,key[1:] != key[:-1]])
+            weights = np.add.reduceat(weights,starts)
+            key = key[starts]
+        src,dst = np.divmod(key,V)
+        indptr = np.searchsorted(src,np.arange(V+1))
+        return cls.__from_csr(csr_graph(labels,indptr,dst,weights))
+
+    @classmethod
+    def __from_csr(cls,frozen):
+        '''graph with the adjacency dicts filled slice by slice from a
+        csr_graph (the in-edge dicts from its transpose), which is kept as
+        the freeze() cache
+        '''
+        labels = frozen.nodes()
+        def adjacency(csr):
+            ends = list(map(labels.__getitem__,csr.indices.tolist()))
+            wts = csr.weights.tolist()
+            ptr = csr.indptr.tolist()
+            return {x:dict(zip(ends[ptr[i]:ptr[i+1]],wts[ptr[i]:ptr[i+1]]))
+                    for i,x in enumerate(labels)}
+        graph = cls()
+        graph.__nodetoN = adjacency(frozen)
+        graph.__nodetoP = adjacency(frozen.reverse())
+        graph.__nodes = labels
+        graph.__nodepos = frozen.index.copy()
+        if len(graph.__nodepos) < len(labels):
+            raise Exception('Invalid node list: labels must be unique')
+        graph.__csr = frozen
+        return graph
+
+    def save(self,path):
+        '''write the graph to the directory path, see csr_graph.save'''
+        self.freeze().save(path)
+
+    @classmethod
+    def load(cls,path,mmap=True):
+        '''graph written by save(). The adjacency dicts are rebuilt in one
+        pass over the arrays, and the loaded (with mmap, memory-mapped)
+        csr_graph is kept as the freeze() cache; processes that only search
+        should use csr_graph.load directly and skip the dicts
+        '''
+        return cls.__from_csr(csr_graph.load(path,mmap))
+
+    @classmethod
+    def from_edge_arrays(cls,sources,targets,weights=None,nodes=None):
+        '''constructor from aligned numpy arrays of edge ends and weights
+        (default 1 per edge). Labels are the array values, or tuples when
+        sources/targets are 2-d with one row per edge end.
+        nodes := optional list of every node label, to fix the node order
+        or include isolated nodes; by default the sorted distinct ends
+        '''
+        sources,targets = np.asarray(sources),np.asarray(targets)
+        if len(sources) != len(targets):
+            raise Exception('sources and targets must have the same length')
+        if weights is None:
+            weights = np.ones(len(sources),dtype=np.int64)
+        elif len(weights) != len(sources):
+            raise Exception('weights must match the number of edges')
+        ends = np.concatenate((sources,targets))
+        if nodes is None:
+            labels,ids = np.unique(ends,axis=0 if ends.ndim == 2 else None,
+                                   return_inverse=True)
+            labels = labels.tolist()
+            if ends.ndim == 2:
+                labels = list(map(tuple,labels))
+        else:
+            labels = list(nodes)
+            index = {x:i for i,x in enumerate(labels)}
+            try:
+                ids = np.fromiter(map(index.__getitem__,
+                                      map(tuple,ends.tolist()) 
+                                      if ends.ndim == 2 else ends.tolist()),
+                                  dtype=np.int64,count=len(ends))
+            except KeyError:
+                raise Exception('edge ends must be among nodes')
+        ids = np.ravel(ids)
+        return cls.__from_ids(labels,ids[:len(sources)],ids[len(sources):],
+                              weights)
+
+    @classmethod
+    def from_sparse(cls,matrix,nodes=None):
+        '''constructor from a scipy.sparse (or any .tocoo()-capable) square
+        matrix, entry [i,j] being the weight of edge i -> j; explicit zeros
+        are dropped and nodes are 0..n-1 unless labels are given in nodes
+        '''
+        if matrix.shape[0] != matrix.shape[1]:
+            raise(Exception('invalid adjacency matrix'))
+        coo = matrix.tocoo()
+        keep = np.abs(coo.data) > 1e-12
+        labels = range(matrix.shape[0]) if nodes is None else nodes
+        if len(labels) != matrix.shape[0]:
+            raise Exception('nodes must label every row of the matrix')
+        return cls.__from_ids(labels,coo.row[keep],coo.col[keep],
+                              coo.data[keep])
+
+    @classmethod
+    def from_grid(cls,costs,neighbours=4):
+        '''graph over the cells (i,j) of a 2-d cost array, where moving into
+        a cell costs its entry; cells with a non-finite cost are walls and
+        left out.
+        neighbours := 4 (orthogonal steps), 8 (with diagonals) or a list
+        of (di,dj) moves, e.g. [(1,0),(0,1)] for down/right-only paths
+        '''
+        costs = np.asarray(costs)
+        if costs.ndim != 2:
+            raise Exception('grid costs must be a 2-d array')
+        if neighbours == 4:
+            moves = [(1,0),(-1,0),(0,1),(0,-1)]
+        elif neighbours == 8:
+            moves = [(di,dj) for di in (-1,0,1) for dj in (-1,0,1) 
+                     if di or dj]
+        else:
+            moves = [tuple(x) for x in neighbours]
+        H,W = costs.shape
+        open_ = np.isfinite(costs)
+        ids = np.full((H,W),-1,dtype=np.int64)
+        ids[open_] = np.arange(np.count_nonzero(open_))
+        src,dst = [],[]
+        for di,dj in moves:
+            if (di,dj) == (0,0) or abs(di) >= H or abs(dj) >= W:
+                continue
+            a = ids[max(0,-di):H-max(0,di),max(0,-dj):W-max(0,dj)]
+            b = ids[max(0,di):H-max(0,-di),max(0,dj):W-max(0,-dj)]
+            ok = (a >= 0) & (b >= 0)
+            src.append(a[ok])
+            dst.append(b[ok])
+        src = np.concatenate(src) if src else np.zeros(0,dtype=np.int64)
+        dst = np.concatenate(dst) if dst else np.zeros(0,dtype=np.int64)
+        labels = list(zip(*(x.tolist() for x in np.nonzero(open_))))
+        return cls.__from_ids(labels,src,dst,costs[open_][dst])
+
     @classmethod
     def fromAM(cls,AdjMatrix:np.matrix):
         '''constructer using adjacency matrix. 
@@ -135,20 +671,25 @@ class directed_graph:
            this feature is required, or represent these as numbers other than
            1 in the adjacency matrix
         '''
-        if len(AdjMatrix) != len(AdjMatrix[1]):
+        AdjMatrix = np.asarray(AdjMatrix)
+        if AdjMatrix.ndim != 2 or AdjMatrix.shape[0] != AdjMatrix.shape[1]:
             raise(Exception('invalid adjacency matrix'))
-        nodetoN = {k: {} for k in range(len(AdjMatrix))}
-        for i,x in enumerate(AdjMatrix):
-            for j,y in enumerate(x):
-                if abs(y) > 1e-12:
-                    nodetoN[i][j] = y
-#                    if AdjMatrix[j][i] != y:
-#                        raise Exception('Adjacency matrix for an undirected' + \
-#                        'graph is symmetric')
-        return cls(nodetoN)
+        src,dst = np.nonzero(np.abs(AdjMatrix) > 1e-12)
+#        if (AdjMatrix != AdjMatrix.T).any():
+#            raise Exception('Adjacency matrix for an undirected' + \
+#            'graph is symmetric')
+        return cls.__from_ids(range(len(AdjMatrix)),src,dst,AdjMatrix[src,dst])
        
     def copy(self):
+        ''' copy that can be modified on its own: the node order, its
+            position index and the edge dicts are duplicated, while the
+            cached results (replaced, never mutated) are shared
+        '''
         cpy = copy.copy(self)
+        cpy.__nodes = self.__nodes.copy()
+        cpy.__nodepos = self.__nodepos.copy()
+        cpy.__nodetoN = {x:nei.copy() for x,nei in self.__nodetoN.items()}
+        cpy.__nodetoP = {x:nei.copy() for x,nei in self.__nodetoP.items()}
         return cpy
     
     def addnode(self,node,connections):
@@ -158,73 +699,100 @@ class directed_graph:
         self.addnodes({node:connections})
         
     def delnodes(self,nodesD,forcevalidate=False):
-        ''' delete a node and its connections
+        ''' delete a node and its connections, in O(degree) per node: the
+        edges are found through the in- and out-edge dicts and the node's
+        slot in self.__nodes is left as a hole for __compact()
         '''
         for node in nodesD:
-            del self.__nodetoN[node]
-            self.__nodes.remove(node)
-            
-        for key in self.__nodes:
-            self.__nodetoN[key] = {x:y for x,y in self.__nodetoN[key].items() if \
-            x not in nodesD}
+            for nei in self.__nodetoN.pop(node):
+                self.__nodetoP[nei].pop(node,None)
+            for nei in self.__nodetoP.pop(node):
+                self.__nodetoN[nei].pop(node,None)
+            self.__nodes[self.__nodepos.pop(node)] = _HOLE
+            self.__holes += 1
+        if self.__holes > len(self.__nodepos):
+            self.__compact()
         if forcevalidate: # for debugging if required
             self.validate()
         
         # now that the graph structure has changed, the following must be recomputed
-        # on demand
-        self.__isdag = None
-        self.__istopsorted = False 
-        self.__istree = None
-        self.__ispositive = None
-        self.__dfslog = {}
+        # on demand. A DAG stays a DAG and keeps its topological order
+        if not self.__isdag:
+            self.__isdag = None
+            self.__istopsorted = False 
+        if self.__ispositive is False:
+            self.__ispositive = None
+        self.__invalidate()
+
+    def __compact(self):
+        '''squeeze the holes left by delnodes out of self.__nodes; called by
+        the methods that walk the whole node list, so its O(V) cost is
+        covered by theirs
+        '''
+        if self.__holes:
+            self.__nodes = [x for x in self.__nodes if x is not _HOLE]
+            self.__nodepos = {x:i for i,x in enumerate(self.__nodes)}
+            self.__holes = 0
     
     def delnode(self,node,forcevalidate=False):
         self.delnodes([node],forcevalidate)
         
     def size(self):
-        n = len(self.__nodes)
+        n = len(self.__nodepos)
         m = sum([sum(x.values()) for x in self.__nodetoN.values()])//2
         return (n,m)
     
     def DFS(self,force_eval=False):
         ''' performs depth-first search on the graph. Outputs a dictionary
-            with in and out times of the search at each node
+            with in and out times of the search at each node.
+            A node is marked when the search enters it and every open node
+            keeps an iterator over its neighbours, so these are the times of
+            a true DFS; meeting a neighbour that is still open (grey) is a
+            back edge, which settles isdag in the same O(V+E) pass. The
+            times are kept as arrays until the graph changes
         '''
-        if len(self.__dfslog) and not force_eval:
-            return self.__dfslog
-            
-        done = {x:False for x in self.__nodes}
-        logs = {x:[None,None] for x in self.__nodes}
-        
-        counter = 0
-        iterstack = []
-        
-        for node in self.__nodes:
-            if done[node]:
-                continue
-            counter += 1
-            iterstack.append([node,counter])
-            done[node] = True
-            for nei in self.__nodetoN[node].keys():
-                if not done[nei]:
-                    iterstack.append([nei,None])
-                    done[nei] = True
-            while len(iterstack)>0:
+        if self.__dfslog is None or force_eval:
+            self.__compact()
+            nodes,pos,nodetoN = self.__nodes,self.__nodepos,self.__nodetoN
+            V = len(nodes)
+            tin,tout = np.zeros(V,dtype=np.int64),np.zeros(V,dtype=np.int64)
+            colour = [0]*V # white, grey (open), black (finished)
+            counter = 0
+            acyclic = True
+            for root in range(V):
+                if colour[root]:
+                    continue
                 counter += 1
-                task = iterstack[-1]
-                if task[1] != None: # you're done.
-                    logs[task[0]] = [task[1],counter]
-                    iterstack.pop()
-                else: # add children to stack and continue
-                    task[1] = counter
-                    for nei in self.__nodetoN[task[0]].keys():
-                        if not done[nei]:
-                            iterstack.append([nei,None])
-                            done[nei] = True
+                tin[root] = counter
+                colour[root] = 1
+                stack = [(root,iter(nodetoN[nodes[root]]))]
+                while stack:
+                    i,neighbours = stack[-1]
+                    for nei in neighbours:
+                        j = pos[nei]
+                        if colour[j] == 0:
+                            counter += 1
+                            tin[j] = counter
+                            colour[j] = 1
+                            stack.append((j,iter(nodetoN[nei])))
+                            break
+                        if colour[j] == 1 and j != i: # self-loops are ignored
+                            acyclic = False
+                    else:
+                        stack.pop()
+                        counter += 1
+                        tout[i] = counter
+                        colour[i] = 2
+            self.__dfslog = (nodes.copy(),tin,tout)
+            self.__isdag = acyclic
+        elif _query.get() is not None:
+            _query.get().count(dfslog_hits=1)
+        nodes,tin,tout = self.__dfslog
+        return {x:[a,b] for x,a,b in zip(nodes,tin.tolist(),tout.tolist())}
                             
 #        recursive form of DFS: lovely to read, but ran into 
 #        maximum recursive depth issues. 
-#        Equally elegant iterstack used above is a replacement
+#        A stack of neighbour iterators, used above, is the replacement
 #        def iterate(node):
 #            nonlocal self,done,logs,counter
 #            if done[node]:
@@ -243,222 +811,374 @@ class directed_graph:
 #            
 #        for node in self.__nodes:
 #            iterate(node)    
-#            
-        return logs
     
     def Topsort(self,force_eval=False):
-        if not self.isdag():
+        ''' puts self.__nodes in topological order with Kahn's algorithm,
+            O(V+E); finding a cycle on the way settles isdag as well
+        '''
+        if self.__isdag is False:
             raise Exception('Graph should be acyclic to allow linearization')
         if self.__istopsorted and not force_eval:
             return
-        logs = self.DFS()
-        self.__nodes = sorted(self.nodes(),key=lambda x:logs[x][1],reverse=True)
+        self.__compact()
+        nodetoN = self.__nodetoN
+        indeg = dict.fromkeys(self.__nodes,0)
+        for node in self.__nodes:
+            for nei in nodetoN[node]:
+                if nei != node:
+                    indeg[nei] += 1
+        order = [x for x in self.__nodes if indeg[x] == 0]
+        for node in order:
+            for nei in nodetoN[node]:
+                if nei != node:
+                    indeg[nei] -= 1
+                    if indeg[nei] == 0:
+                        order.append(nei)
+        if len(order) < len(self.__nodes):
+            self.__isdag = False
+            raise Exception('Graph should be acyclic to allow linearization')
+        self.__isdag = True
+        self.__nodes = order
+        self.__nodepos = {x:i for i,x in enumerate(self.__nodes)}
         self.__istopsorted = True
-                    
-    def dagpath(self,node_start,node_fin):
+
+    def __insert_order(self,node1,node2):
+        ''' repair the topological order for a new edge node1 -> node2
+            (Pearce-Kelly). Only nodes between the two positions can be out
+            of order: those reachable from node2 (forward search) and those
+            reaching node1 (backward search over the in-edges) swap into
+            each other's slots, ancestors first, so the cost is the size of
+            the affected region rather than the graph. Returns False,
+            leaving the order untouched, if the edge closes a cycle
+        '''
+        pos = self.__nodepos
+        lb,ub = pos[node2],pos[node1]
+        if lb > ub:
+            return True
+        def search(root,edges,inside):
+            seen = {root}
+            stack = [root]
+            while stack:
+                for nei in edges[stack.pop()]:
+                    if nei not in seen and inside(pos[nei]):
+                        seen.add(nei)
+                        stack.append(nei)
+            return seen
+        fwd = search(node2,self.__nodetoN,lambda p: p <= ub)
+        if node1 in fwd:
+            return False
+        bwd = search(node1,self.__nodetoP,lambda p: p > lb)
+        moved = sorted(bwd,key=pos.get) + sorted(fwd,key=pos.get)
+        for x,i in zip(moved,sorted(pos[x] for x in moved)):
+            self.__nodes[i] = x
+            pos[x] = i
+        return True
+
+    def __order_added(self,nodes):
+        ''' repair the topological order after addnodes() appended nodes
+            at the end. They have no in-edges from the old nodes, so those
+            without out-edges are already in place; the out-edges are taken
+            out and put back one at a time, each repaired by
+            __insert_order() as in add_edges, at the cost of the affected
+            regions rather than a rebuild of the order
+        '''
+        pending = []
+        for x in nodes:
+            for y in self.__nodetoN[x]:
+                del self.__nodetoP[y][x]
+            pending.append((x,self.__nodetoN[x]))
+            self.__nodetoN[x] = {}
+        for x,nei in pending:
+            for y,w in nei.items():
+                self.__nodetoN[x][y] = w
+                self.__nodetoP[y][x] = w
+                if not self.__isdag:
+                    continue # unknown or cyclic already
+                if x == y or y not in self.__nodepos:
+                    self.__isdag = None # self-loop or dangling, left to DFS
+                    self.__istopsorted = False
+                elif not self.__insert_order(x,y):
+                    self.__isdag = False
+                    self.__istopsorted = False
+
+    def dagpath(self,node_start,node_fin,mode='shortest'):
         ''' User advised to use wrapper: shortest_path()
             Use for finding shortest path in directed acyclic graph
             with V vertices and E edges
-            complexity = O(V log V + E)
-            (V log V is the complexity of node sort in Topsort())
+            complexity = O(V + E), in one sweep of the topological order
+            from node_start up to the last of the targets
+            mode := 'shortest', 'longest' for the heaviest path (the
+            critical path when weights are durations), or 'count' for the
+            number of distinct paths to each target as plain ints.
+            Unreachable targets give (inf,[]), (-inf,[]) and 0 respectively
             node_fin is assumed to be a list of nodes, and 
             node_start is assumed to be a single node
         '''
+        if mode not in ('shortest','longest','count'):
+            raise Exception('unknown dagpath mode ' + str(mode))
+        record = _query.get()
+        if record is not None:
+            start = time.perf_counter()
         self.Topsort()
-        istart = self.__nodes.index(node_start)
-        iend = max([self.__nodes.index(x) for x in node_fin])
+        if record is not None:
+            record.phase('topsort',start)
+        pos = self.__nodepos
+        istart = pos[node_start]
+        iend = max([pos[x] for x in node_fin])
         nodeslice = self.__nodes[istart:iend+1]
-        dist = {x:np.inf for x in nodeslice}
-        pred = {x:None for x in nodeslice}
-        dist[node_start] = 0
+        if mode == 'count':
+            count = {node_start:1}
+            for x in nodeslice:
+                if x not in count:
+                    continue
+                for nei in self.__nodetoN[x]:
+                    if nei != x and pos[nei] <= iend:
+                        count[nei] = count.get(nei,0) + count[x]
+            return [count.get(nf,0) for nf in node_fin]
+        sign = 1 if mode == 'shortest' else -1 # longest = shortest on -weights
+        dist = {node_start:0}
+        pred = {node_start:None}
+        relaxed = 0
         for x in nodeslice:
+            if x not in dist:
+                continue
+            for nei,length in self.__nodetoN[x].items():
+                if nei == x or pos[nei] > iend:
+                    continue
+                if dist[x]+sign*length < dist.get(nei,np.inf):
+                    dist[nei] = dist[x]+sign*length
+                    pred[nei] = x
+                    relaxed += 1
+        if record is not None:
+            record.count(nodes_settled=len(dist),edges_relaxed=relaxed)
+        return [(sign*dist[nf],_trace(pred,nf)) if nf in dist else 
+                (sign*np.inf,[]) for nf in node_fin]
+
+    def critical_path(self):
+        ''' heaviest path anywhere in the acyclic graph, e.g. the critical
+            path of a task graph with durations as edge weights, as a
+            (length,path) tuple
+        '''
+        self.Topsort()
+        self.__compact()
+        if not self.__nodes:
+            return (0,[])
+        dist = dict.fromkeys(self.__nodes,0)
+        pred = dict.fromkeys(self.__nodes)
+        for x in self.__nodes:
             for nei,length in self.__nodetoN[x].items():
-                if dist[x]+length < dist[nei]:
+                if nei != x and dist[x]+length > dist[nei]:
                     dist[nei] = dist[x]+length
                     pred[nei] = x
-        result = []
-        for nf in node_fin:
-            stack = [nf]
-            while stack[-1] != node_start:
-                temp = pred[stack[-1]]
-                stack.append(temp)
-            stack.reverse()
-            result.append((dist[nf],stack))
-        return result
-        
-    def __decrease_key(self,pos,heap,nodepos):
-        parent = pos
-        # swaps are only done upwards since key is decreased
-        while parent > 0: 
-            parent = (parent-1)//2
-            if heap[parent][0]>heap[pos][0]:
-                # switch nodes in heap
-                temp = heap[parent]
-                heap[parent] = heap[pos]
-                heap[pos] = temp
-                nodepos[heap[pos][1]] = pos
-                nodepos[heap[parent][1]] = parent
-                pos = parent
-            else:
-                break
-            
-    def __heap_pop(self,heap,nodepos):
-        lheap = len(heap)
-        if lheap == 0:
-            raise Exception('Cant pop empty heap')
-        elif lheap == 1:
-            nodepos[heap[0][1]] = None
-            return heap.pop()
-        ind = 0
-        pop = heap[ind]
-        nodepos[pop[1]] = None
-        heap[ind] = heap[-1]
-        del heap[-1] 
-        lheap -= 1
-        nodepos[heap[ind][1]] = ind
+        end = max(self.__nodes,key=dist.__getitem__)
+        return (dist[end],_trace(pred,end))
         
-        while 2*ind+1 < lheap:
-            if 2*ind+2 == lheap or heap[2*ind+1][0]<heap[2*ind+2][0]:
-                child = 2*ind+1
-            else:
-                child = 2*ind+2
-            if heap[ind][0]>heap[child][0]:
-                # switch nodes in heap
-                temp = heap[ind]
-                heap[ind] = heap[child]
-                heap[child] = temp
-                nodepos[heap[ind][1]]=ind
-                nodepos[heap[child][1]]=child
-                ind = child
-            else:
-                break
-        return pop
-            
-    def dijkstra(self,nodestart,node_fin):
+    def dijkstra(self,nodestart,node_fin,max_dist=np.inf,max_nodes=None):
         ''' User advised to use wrapper: shortest_path()
             Use for finding shortest path in in a graph with positive edge
             weights containing cycles.
-            Priority queue is implemented with a binary heap, resulting in 
-            a complexity of O(VlogV)
+            Priority queue is a heapq binary heap with lazy deletion, and the
+            search stops as soon as every node in node_fin is settled, so the
+            cost is O(E' log V') in the explored region only.
+            max_dist, max_nodes := optional cutoffs on the settled distance
+            and on the number of settled nodes; targets not settled by then
+            come back as (inf,[]) just like unreachable ones
             node_fin is assumed to be a list of nodes, and 
             node_start is assumed to be a single node
         '''
-        nodes = sorted(self.__nodes)
-        d = [(np.inf,x) for x in nodes] # priority queue
-        
-        nodepos = {x:y for y,x in enumerate(nodes)} # required for lookup later
-        pos = nodepos[nodestart]
-        d[pos] = (0,nodestart)
-        self.__decrease_key(pos,d,nodepos)
-        dist = {x[1]:x[0] for x in d}
-        prev = {x[1]:None for x in d}
+        nodetoN = self.__nodetoN
+        dist,pred = _dijkstra(lambda u: nodetoN[u].items(),nodestart,
+                              node_fin,max_dist,max_nodes)
+        return [(dist[nf],_trace(pred,nf)) if nf in pred else (np.inf,[])
+                for nf in node_fin]
         
-        while d != []:
-            distmin,min_node = self.__heap_pop(d,nodepos)            
-            for nei,length in self.__nodetoN[min_node].items():
-                if dist[nei] > distmin +length and nei != min_node:
-                    # pos = self.__bsearch(nei,nodes)
-                    pos = nodepos[nei]
-                    dist[nei] = dist[min_node]+length
-                    prev[nei] = min_node
-                    d[pos] = (dist[nei],nei) 
-                    self.__decrease_key(pos,d,nodepos)
-        result = []
-        for nf in node_fin:
-            total = dist[nf]
-            path = [nf]
-            while path[-1] != nodestart:
-                path.append(prev[path[-1]])
-            path.reverse()
-            result.append((total,path))
-        return result
-        
-    def bellman_ford(self,nodestart,node_fin):
+    def bellman_ford(self,nodestart,node_fin,spfa=False):
         ''' Bellman-Ford algorithm for graphs with cycles and negative
-        edges. Throws if a negative cycle is found
+        edges. Throws NegativeCycleError, carrying the cycle, if a negative
+        cycle is reachable.
+        By default every pass relaxes all edges at once on the numpy edge
+        arrays of freeze() and the passes stop as soon as one changes
+        nothing; spfa = True runs the queue-based variant directly on the
+        adjacency dictionaries instead, which only touches the nodes whose
+        distance changed
         '''
-        
-        nodes = sorted(self.__nodes)
-        
-        # change edge representation
-        edges = {}
-        for node in nodes:
-            for node2,weight in self.__nodetoN[node].items():
-                edges[(node,node2)] = weight
-                
-        dist = {x:np.inf for x in nodes}
-        dist[nodestart] = 0
-        prev = {x:None for x in nodes}
-        
-        for x in range(len(nodes)-1):
-            for edge,weight in edges.items():
-                ecan = dist[edge[0]] + weight
-                if ecan < dist[edge[1]]:
-                    dist[edge[1]] = ecan
-                    prev[edge[1]] = edge[0]
-                
-        flag = True
-        for edge,weight in edges.items():
-            ecan = dist[edge[0]] + weight
-            if ecan < dist[edge[1]]:
-                flag = False
-                break
-            
-        if flag:
-            result = []
-            for nf in node_fin:
-                total = dist[nf]
-                path = [nf]
-                while path[-1] != nodestart:
-                    path.append(prev[path[-1]])
-                path.reverse()
-                result.append((total,path))
-            return result 
-        else:
-            raise Exception('Negative cycle found')
+        if not spfa:
+            return self.freeze().bellman_ford(nodestart,node_fin)
+        nodetoN = self.__nodetoN
+        dist,pred = _spfa(lambda u: nodetoN[u].items(),nodestart,
+                          len(self.__nodepos))
+        return [(dist[nf],_trace(pred,nf)) if nf in pred else (np.inf,[])
+                for nf in node_fin]
     
         
-    def shortest_path(self,node_start,node_fin):
+    def shortest_path(self,node_start,node_fin,method='auto',heuristic=None):
+        ''' shortest path(s) from node_start to node_fin (a node or a list
+            of nodes) as (distance,path) tuples.
+            method := 'auto' answers from the contraction hierarchy if
+            build_query_index() has been called since the last change, and
+            otherwise picks dagpath for acyclic graphs, dijkstra for
+            non-negative weights and sccpath for the rest; 'ch', 'dag',
+            'dijkstra', 'scc', 'bellman_ford' and 'spfa' (bellman_ford with
+            spfa=True) force one of those, and the
+            point-to-point modes for non-negative weights are
+            'bidirectional' (Dijkstra from both ends over the in-edge
+            index) and 'astar'
+            heuristic := for 'astar', h(node,target) never overestimating
+            the distance, or one of 'manhattan', 'euclidean', 'chebyshev'
+            for tuple-labelled grid nodes, scaled by metric_scale()
+            See set_stats_hook/collect_stats to record what a query did
+        '''
+        if _stats_hook is None:
+            return self.__shortest_path(node_start,node_fin,method,heuristic)
+        cache = {'isdag':self.__isdag is not None,
+                 'topsort':bool(self.__isdag and self.__istopsorted),
+                 'dfslog':self.__dfslog is not None,
+                 'freeze':self.__csr is not None,
+                 'chindex':self.__chindex is not None}
+        return _recorded(self,self.__shortest_path,cache,node_start,node_fin,
+                         method,heuristic)
+
+    def __shortest_path(self,node_start,node_fin,method,heuristic):
         flag = False
         if not isinstance(node_fin,list):
             node_fin = [node_fin]
             flag = True
-        if self.isdag():
+        record = _query.get()
+        if method == 'auto':
+            if record is not None:
+                start = time.perf_counter()
+            if self.__chindex is not None:
+                method = 'ch'
+            elif self.isdag():
+                method = 'dag'
+            elif self.ispositive():
+                method = 'dijkstra'
+            else:
+                method = 'scc'
+            if record is not None:
+                record.phase('dispatch',start)
+        if record is not None:
+            record.method = method
+        if method == 'ch':
+            result = [self.build_query_index().query(node_start,nf) 
+                      for nf in node_fin]
+        elif method == 'dag':
             result = self.dagpath(node_start,node_fin) # dag shortest path O(|V|+|E|)
+        elif method == 'dijkstra': # dijkstra for positive edges O((|V|+|E|)log|V|)
+            result = self.dijkstra(node_start,node_fin)   
+        elif method == 'bellman_ford':
+            result = self.bellman_ford(node_start,node_fin) 
+        elif method == 'spfa':
+            result = self.bellman_ford(node_start,node_fin,spfa=True)
+        elif method == 'scc':
+            result = self.sccpath(node_start,node_fin)
+        elif method in ('bidirectional','astar'):
+            nodetoN,nodetoP = self.__nodetoN,self.__nodetoP
+            result = _point_to_point(self,node_start,node_fin,method,
+                                     heuristic,lambda u: nodetoN[u].items(),
+                                     lambda u: nodetoP[u].items())
         else:
-            if self.ispositive(): # dijkstra for positive edges O((|V|+|E|)log|V|)
-                result = self.dijkstra(node_start,node_fin)   
-            else:
-                result = self.bellman_ford(node_start,node_fin) 
+            raise Exception('unknown shortest path method ' + str(method))
         if flag:
             return result[0]
         else:
             return result
+
+    def scc(self):
+        '''strongly connected component id of every node, as an int32 array
+        aligned with nodes(); see csr_graph.scc
+        '''
+        return self.freeze().scc()
+
+    def sccpath(self,node_start,node_fin):
+        ''' User advised to use wrapper: shortest_path()
+            shortest paths for cyclic graphs with negative edges, running
+            the general search only inside the strongly connected
+            components; see csr_graph.sccpath
+        '''
+        return self.freeze().sccpath(node_start,node_fin)
+
+    def distance_matrix(self,sources,targets=None,workers=None,out=None):
+        '''dense numpy matrix of shortest distances from every node in
+        sources to every node in targets (all nodes if None), computed on
+        freeze() - see csr_graph.distance_matrix for workers and out
+        '''
+        return self.freeze().distance_matrix(sources,targets,workers,out)
+
+    def build_query_index(self):
+        '''preprocess the graph into a contraction hierarchy so that
+        repeated point-to-point shortest_path queries run as small upward
+        searches; returns the index. Any later change to the graph drops it
+        '''
+        if self.__chindex is None:
+            self.__chindex = contraction_hierarchy(self.freeze())
+        return self.__chindex
+
+    def predecessors(self,node):
+        return self.__nodetoP[node].copy()
+
     def nodes(self):
+        self.__compact()
         return self.__nodes.copy()
         
     def neighbours(self,node):
         return self.__nodetoN[node].copy()
+
+    def to_csr(self):
+        '''compact copy of the graph as a csr_graph: node labels interned to
+        int32 ids in the order of nodes(), and the adjacency held in numpy
+        indptr/indices/weights arrays
+        '''
+        self.__compact()
+        index = {x:i for i,x in enumerate(self.__nodes)}
+        indptr = np.zeros(len(self.__nodes)+1,dtype=np.int64)
+        np.cumsum([len(self.__nodetoN[x]) for x in self.__nodes],
+                  out=indptr[1:])
+        indices = np.fromiter((index[y] for x in self.__nodes
+                               for y in self.__nodetoN[x]),
+                              dtype=np.int32,count=indptr[-1])
+        weights = np.array([w for x in self.__nodes
+                            for w in self.__nodetoN[x].values()])
+        return csr_graph(self.__nodes,indptr,indices,weights)
+
+    def freeze(self):
+        '''cached csr_graph view of the graph (see to_csr), rebuilt only
+        after the graph has been modified
+        '''
+        if self.__csr is None:
+            self.__csr = self.to_csr()
+        return self.__csr
         
     def isdag(self,force_eval=False):
+        ''' True if the graph has no cycle (self-loops aside); settled by the
+            colouring in DFS() unless edge insertions have kept it current
+        '''
         if self.__isdag == None or force_eval:
-            flag = True
-            logs = self.DFS()
-            for node in self.__nodes:
-                for k in self.__nodetoN[node].keys():
-                    if logs[k][0]<logs[node][0] and logs[k][1]>logs[node][1]:
-                        flag = False # found a back edge
-                        break
-                else:
-                    continue
-                break
-            self.__isdag = flag
-            
+            self.DFS(force_eval=True)
+        elif _query.get() is not None:
+            _query.get().count(isdag_hits=1)
         return self.__isdag
+
+    def bfs(self,node_start,within=None):
+        '''breadth-first levels from node_start as an array aligned with
+        nodes(), -1 where unreached; see csr_graph.bfs
+        '''
+        return self.freeze().bfs(node_start,within)
+
+    def reachable(self,node_start,within=None):
+        '''nodes reachable from node_start, itself included, optionally
+        moving only through the nodes in within
+        '''
+        return self.freeze().reachable(node_start,within)
+
+    def descendants(self,node,within=None):
+        '''nodes reachable from node, not counting node itself'''
+        return self.freeze().descendants(node,within)
     
     def ispositive(self,force_eval=False):
         if self.__ispositive == None or force_eval:
             self.__ispositive = True
+            self.__compact()
             for node in self.__nodes:
                 for v in self.__nodetoN[node].values():
                     if v<0:
@@ -469,6 +1189,26 @@ class directed_graph:
                 break 
         return self.__ispositive
         
+    def min_weight(self,force_eval=False):
+        '''smallest edge weight in the graph (inf if there are no edges)'''
+        if self.__minweight is None or force_eval:
+            self.__minweight = min((min(val.values()) for val in 
+                                    self.__nodetoN.values() if val),
+                                   default=np.inf)
+        return self.__minweight
+
+    def metric_scale(self,name):
+        '''largest s such that s*metric(u,v) <= w(u,v) on every edge, for
+        the grid metric name ('manhattan', 'euclidean' or 'chebyshev'); the
+        scaled metric is then an admissible astar heuristic, 8-neighbour
+        grids included
+        '''
+        if name not in self.__metricscale:
+            self.__metricscale[name] = _metric_scale(_HEURISTICS[name],
+                ((x,y,w) for x,nei in self.__nodetoN.items() 
+                 for y,w in nei.items()))
+        return self.__metricscale[name]
+
     def istree(self,force_eval=False):
         if self.__istree == None or force_eval:
             raise Exception('istree unimplemented')
@@ -550,3 +1290,850 @@ class directed_graph:
 #        
 #        self.__nodes = [x for x in self.__nodetoN.keys()]
         
+
+
+_CSR_ARRAYS = ('indptr','indices','weights') # the .npy files of csr_graph.save
+
+def _label_array(labels):
+    '''labels as a numpy array if they are all ints, all strings or all
+    int tuples of one length - the forms that round-trip through .npy
+    without pickling - else None
+    '''
+    if all(type(x) is int for x in labels):
+        arr = np.array(labels)
+        return arr if arr.dtype.kind == 'i' else None # no int64 overflow
+    if all(type(x) is str for x in labels):
+        return np.array(labels,dtype=str)
+    if labels and all(type(x) is tuple and len(x) == len(labels[0]) and 
+                      all(type(y) is int for y in x) for x in labels):
+        arr = np.array(labels)
+        return arr if arr.dtype.kind == 'i' and arr.ndim == 2 else None
+    return None
+
+def _distance_block(indptr,indices,weights,sources,targets,h,out):
+    '''out[r,:] = distances from node id sources[r] to the ids targets,
+    searching on (reweighted) weights and undoing the potentials h
+    '''
+    def succ(u):
+        a,b = indptr[u:u+2].tolist()
+        return zip(indices[a:b].tolist(),weights[a:b].tolist())
+    tlist = targets.tolist()
+    for r,s in enumerate(sources.tolist()):
+        dist,_ = _dijkstra(succ,s,tlist)
+        out[r] = np.array([dist.get(t,np.inf) for t in tlist])-h[s]+h[targets]
+
+def _distance_worker(graphspecs,outspec,lo,hi,sources,targets,hs,ht):
+    attached = [_parallel.attach_array(spec)
+                for spec in graphspecs+[outspec]]
+    try:
+        (_,indptr),(_,indices),(_,weights),(_,out) = attached
+        # potentials arrive pre-indexed: h[sources] and h[targets]
+        h = np.zeros(len(indptr)-1,dtype=ht.dtype)
+        h[sources],h[targets] = hs,ht
+        _distance_block(indptr,indices,weights,sources,targets,h,
+                        out[lo:hi])
+        if isinstance(out,np.memmap):
+            out.flush()
+    finally:
+        del indptr,indices,weights,out
+        for shm,_ in attached:
+            if shm is not None:
+                shm.close()
+
+def _edge_ranges(indptr,nodes):
+    '''positions in the CSR edge arrays of all out-edges of nodes'''
+    starts = indptr[nodes]
+    counts = indptr[nodes+1]-starts
+    offsets = np.cumsum(counts)-counts
+    return np.repeat(starts-offsets,counts)+np.arange(counts.sum())
+
+class csr_graph:
+    '''Frozen directed graph in compressed sparse row form, as produced by
+    directed_graph.freeze() or to_csr(). Node labels are interned to int32
+    ids (their position in labels), and the out-edges of node i are
+    indices[indptr[i]:indptr[i+1]] with matching weights, so an edge costs
+    a few bytes instead of a dictionary entry. Search methods take and
+    return the original node labels.
+    '''
+
+    def __init__(self,labels,indptr,indices,weights):
+        self.labels = list(labels)
+        self.index = {x:i for i,x in enumerate(self.labels)}
+        # asanyarray keeps memory-mapped arrays from load() mapped
+        self.indptr = np.asanyarray(indptr,dtype=np.int64)
+        self.indices = np.asanyarray(indices,dtype=np.int32)
+        self.weights = np.asanyarray(weights)
+        if self.weights.dtype.kind not in 'iuf':
+            self.weights = self.weights.astype(np.float64)
+        self.__levels = None # Kahn levels of the nodes, [] if cyclic
+        self.__scc = None # (component ids, node ids grouped by component, bounds)
+        self.__dfslog = None # (entry times,exit times) arrays
+        self.__reverse = None
+        self.__chindex = None
+        self.__metricscale = {} # grid metric name -> metric_scale()
+        self.__files = {} # array name -> .npy path when memory-mapped
+
+    def save(self,path):
+        '''write the graph to the directory path (created if needed) as
+        indptr.npy, indices.npy and weights.npy plus the node labels: as
+        labels.npy when they are all ints, all strings or all int tuples of
+        one length, pickled to labels.pkl otherwise
+        '''
+        os.makedirs(path,exist_ok=True)
+        for name in _CSR_ARRAYS:
+            np.save(os.path.join(path,name + '.npy'),getattr(self,name))
+        for name in ('labels.npy','labels.pkl'):
+            if os.path.exists(os.path.join(path,name)):
+                os.remove(os.path.join(path,name))
+        labels = _label_array(self.labels)
+        if labels is not None:
+            np.save(os.path.join(path,'labels.npy'),labels)
+        else:
+            with open(os.path.join(path,'labels.pkl'),'wb') as f:
+                pickle.dump(self.labels,f,protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls,path,mmap=True):
+        '''csr_graph written by save(). With mmap the edge arrays are
+        mapped read-only from their files instead of read, so loading is
+        O(V) for the labels only and processes loading the same graph share
+        one copy in the page cache; process pools in distance_matrix then
+        map the files too rather than copying the arrays to shared memory
+        '''
+        files = {name:os.path.join(path,name + '.npy') for name in _CSR_ARRAYS}
+        arrays = [np.load(files[name],mmap_mode='r' if mmap else None)
+                  for name in _CSR_ARRAYS]
+        if os.path.exists(os.path.join(path,'labels.npy')):
+            labels = np.load(os.path.join(path,'labels.npy'))
+            labels = labels.tolist() if labels.ndim == 1 else \
+                     list(map(tuple,labels.tolist()))
+        else:
+            with open(os.path.join(path,'labels.pkl'),'rb') as f:
+                labels = pickle.load(f)
+        graph = cls(labels,*arrays)
+        if mmap:
+            graph.__files = {name:os.path.abspath(files[name]) 
+                             for name in _CSR_ARRAYS 
+                             if isinstance(getattr(graph,name),np.memmap)}
+        return graph
+
+    def size(self):
+        return (len(self.labels),len(self.indices))
+
+    def nodes(self):
+        return self.labels.copy()
+
+    def neighbours(self,node):
+        i = self.index[node]
+        a,b = self.indptr[i],self.indptr[i+1]
+        return {self.labels[j]:w for j,w in 
+                zip(self.indices[a:b].tolist(),self.weights[a:b].tolist())}
+
+    def sources(self):
+        '''source node id of every edge, aligned with indices/weights'''
+        return np.repeat(np.arange(len(self.labels),dtype=np.int32),
+                         np.diff(self.indptr))
+
+    def __number(self,d):
+        # integer weights give integer distances, as in directed_graph
+        if self.weights.dtype.kind in 'iu' and np.isfinite(d):
+            return int(d)
+        return float(d)
+
+    def __paths(self,start,targets,dist,pred):
+        '''(distance,path) per target label from id-level dist/pred arrays;
+        unreachable targets give (inf,[])
+        '''
+        record = _query.get()
+        if record is not None:
+            clock = time.perf_counter()
+        result = []
+        for nf in targets:
+            t = self.index[nf]
+            if not np.isfinite(dist[t]):
+                result.append((np.inf,[]))
+                continue
+            path = [t]
+            while path[-1] != start:
+                path.append(pred[path[-1]])
+            result.append((self.__number(dist[t]),
+                           [self.labels[x] for x in reversed(path)]))
+        if record is not None:
+            record.phase('paths',clock)
+        return result
+
+    def DFS(self,force_eval=False):
+        ''' depth-first search over the whole graph; dictionary with the
+            in and out times of the search at each node (kept as arrays)
+        '''
+        if self.__dfslog is None or force_eval:
+            V = len(self.labels)
+            indptr,indices = self.indptr.tolist(),self.indices.tolist()
+            tin,tout = [0]*V,[0]*V
+            seen = [False]*V
+            counter = 0
+            for root in range(V):
+                if seen[root]:
+                    continue
+                seen[root] = True
+                counter += 1
+                tin[root] = counter
+                stack = [(root,indptr[root])]
+                while stack:
+                    node,e = stack[-1]
+                    end = indptr[node+1]
+                    while e < end and seen[indices[e]]:
+                        e += 1
+                    if e < end:
+                        child = indices[e]
+                        stack[-1] = (node,e+1)
+                        seen[child] = True
+                        counter += 1
+                        tin[child] = counter
+                        stack.append((child,indptr[child]))
+                    else:
+                        stack.pop()
+                        counter += 1
+                        tout[node] = counter
+            self.__dfslog = (np.array(tin,dtype=np.int64),
+                             np.array(tout,dtype=np.int64))
+        tin,tout = self.__dfslog
+        return {x:[a,b] for x,a,b in zip(self.labels,tin.tolist(),tout.tolist())}
+
+    def bfs(self,node_start,within=None):
+        '''breadth-first levels from node_start as an int64 array over node
+        ids, -1 where unreached; each frontier is expanded in one vectorized
+        step over its edge ranges.
+        within := optional collection of nodes the search may enter, to
+        search a subgraph (node_start itself is always entered)
+        '''
+        level = np.full(len(self.labels),-1,dtype=np.int64)
+        allowed = None
+        if within is not None:
+            allowed = np.zeros(len(self.labels),dtype=bool)
+            allowed[np.fromiter((self.index[x] for x in within),
+                                dtype=np.int64)] = True
+        frontier = np.array([self.index[node_start]],dtype=np.int64)
+        depth = 0
+        while len(frontier):
+            level[frontier] = depth
+            depth += 1
+            succ = self.indices[_edge_ranges(self.indptr,frontier)]
+            succ = succ[level[succ] < 0]
+            if allowed is not None:
+                succ = succ[allowed[succ]]
+            frontier = np.unique(succ)
+        return level
+
+    def reachable(self,node_start,within=None):
+        '''labels reachable from node_start, itself included, optionally
+        moving only through the nodes in within
+        '''
+        return [self.labels[i] for i in 
+                np.flatnonzero(self.bfs(node_start,within) >= 0).tolist()]
+
+    def descendants(self,node,within=None):
+        '''labels reachable from node, not counting node itself'''
+        return [self.labels[i] for i in 
+                np.flatnonzero(self.bfs(node,within) > 0).tolist()]
+
+    def __kahn_levels(self):
+        '''topological order as a list of id arrays, level by level (every
+        edge goes to a later level); [] if the graph has a cycle
+        '''
+        if self.__levels is None:
+            V = len(self.labels)
+            indeg = np.bincount(self.indices,minlength=V)
+            frontier = np.flatnonzero(indeg == 0)
+            levels,done = [],0
+            while len(frontier):
+                levels.append(frontier)
+                done += len(frontier)
+                succ = self.indices[_edge_ranges(self.indptr,frontier)]
+                np.subtract.at(indeg,succ,1)
+                frontier = np.unique(succ[indeg[succ] == 0])
+            self.__levels = levels if done == V else []
+        return self.__levels
+
+    def isdag(self):
+        return len(self.labels) == 0 or len(self.__kahn_levels()) > 0
+
+    def ispositive(self):
+        return not (self.weights < 0).any()
+
+    def Topsort(self):
+        '''node labels in topological order'''
+        if not self.isdag():
+            raise Exception('Graph should be acyclic to allow linearization')
+        return [self.labels[i] for level in self.__kahn_levels() 
+                for i in level.tolist()]
+
+    def dagpath(self,node_start,node_fin,mode='shortest'):
+        ''' shortest paths from node_start to the list node_fin in an
+            acyclic graph. Nodes are relaxed a Kahn level at a time, all the
+            out-edges of a level in one vectorized step - O(V+E) overall.
+            mode := 'shortest', 'longest' or 'count' as for
+            directed_graph.dagpath
+        '''
+        if mode not in ('shortest','longest','count'):
+            raise Exception('unknown dagpath mode ' + str(mode))
+        record = _query.get()
+        if record is not None:
+            start = time.perf_counter()
+        if not self.isdag():
+            raise Exception('Graph should be acyclic to allow linearization')
+        if record is not None:
+            record.phase('topsort',start)
+        s = self.index[node_start]
+        if mode == 'count':
+            acc = np.zeros(len(self.labels),dtype=object) # exact big counts
+            acc[s] = 1
+        else:
+            acc = np.full(len(self.labels),np.inf)
+            acc[s] = 0
+        weights = -self.weights.astype(np.float64) if mode == 'longest' \
+                  else self.weights
+        pred = np.full(len(self.labels),-1,dtype=np.int64)
+        started = False
+        for level in self.__kahn_levels():
+            if not started:
+                if s not in level:
+                    continue
+                started = True
+            edges = _edge_ranges(self.indptr,level)
+            if len(edges) == 0:
+                continue
+            src = np.repeat(level,np.diff(self.indptr)[level])
+            dst = self.indices[edges]
+            if mode == 'count':
+                np.add.at(acc,dst,acc[src])
+                continue
+            cand = acc[src]+weights[edges]
+            old = acc[dst]
+            np.minimum.at(acc,dst,cand)
+            won = (cand < old) & (cand == acc[dst])
+            pred[dst[won]] = src[won]
+            if record is not None:
+                record.count(edges_relaxed=int(np.count_nonzero(cand < old)))
+        if record is not None:
+            reached = acc != 0 if mode == 'count' else acc != np.inf
+            record.count(nodes_settled=int(np.count_nonzero(reached)))
+        if mode == 'count':
+            return [acc[self.index[nf]] for nf in node_fin]
+        result = self.__paths(s,node_fin,acc,pred.tolist())
+        if mode == 'longest':
+            result = [(-d,path) for d,path in result]
+        return result
+
+    def critical_path(self):
+        ''' heaviest path anywhere in the acyclic graph as (length,path),
+            see directed_graph.critical_path
+        '''
+        if not self.isdag():
+            raise Exception('Graph should be acyclic to allow linearization')
+        if len(self.labels) == 0:
+            return (0,[])
+        dist = np.zeros(len(self.labels),dtype=self.weights.dtype)
+        pred = np.full(len(self.labels),-1,dtype=np.int64)
+        for level in self.__kahn_levels():
+            edges = _edge_ranges(self.indptr,level)
+            src = np.repeat(level,np.diff(self.indptr)[level])
+            dst = self.indices[edges]
+            cand = dist[src]+self.weights[edges]
+            old = dist[dst]
+            np.maximum.at(dist,dst,cand)
+            won = (cand > old) & (cand == dist[dst])
+            pred[dst[won]] = src[won]
+        path = [int(np.argmax(dist))]
+        while pred[path[-1]] >= 0:
+            path.append(int(pred[path[-1]]))
+        return (self.__number(dist[path[0]]),
+                [self.labels[x] for x in reversed(path)])
+
+    def _succ(self,u):
+        a,b = self.indptr[u:u+2].tolist()
+        return zip(self.indices[a:b].tolist(),self.weights[a:b].tolist())
+
+    def dijkstra(self,node_start,node_fin,max_dist=np.inf,max_nodes=None):
+        ''' shortest paths for non-negative edge weights, same engine and
+            cutoffs as directed_graph.dijkstra
+        '''
+        dist,pred = _dijkstra(self._succ,self.index[node_start],
+                              [self.index[x] for x in node_fin],
+                              max_dist,max_nodes)
+        result = []
+        for nf in node_fin:
+            t = self.index[nf]
+            if t in pred:
+                result.append((dist[t],
+                               [self.labels[x] for x in _trace(pred,t)]))
+            else:
+                result.append((np.inf,[]))
+        return result
+
+    def bellman_ford(self,node_start,node_fin,spfa=False):
+        ''' Bellman-Ford for graphs with cycles and negative edges: every
+            pass relaxes all edges at once on the edge arrays (np.minimum.at
+            per destination), stopping as soon as a pass changes nothing.
+            spfa = True runs the queue-based variant instead. Throws
+            NegativeCycleError, carrying the cycle, if a negative cycle is
+            reachable
+        '''
+        V = len(self.labels)
+        s = self.index[node_start]
+        if spfa:
+            try:
+                dist,pred = _spfa(self._succ,s,V)
+            except NegativeCycleError as e:
+                raise NegativeCycleError([self.labels[x] for x in e.cycle])
+            return [(dist[t],[self.labels[x] for x in _trace(pred,t)]) 
+                    if t in pred else (np.inf,[]) 
+                    for t in (self.index[nf] for nf in node_fin)]
+        dist = np.full(V,np.inf)
+        pred = np.full(V,-1,dtype=np.int64)
+        dist[s] = 0
+        self.__relax_passes(dist,pred)
+        return self.__paths(s,node_fin,dist,pred.tolist())
+
+    def __relax_passes(self,dist,pred):
+        '''vectorized Bellman-Ford passes updating dist/pred in place until
+        nothing changes; NegativeCycleError if still changing after V passes
+        '''
+        src,dst,w = self.sources(),self.indices,self.weights
+        record = _query.get()
+        for _ in range(len(self.labels)):
+            cand = dist[src]+w
+            better = cand < dist[dst]
+            if record is not None:
+                record.count(bf_passes=1,
+                             edges_relaxed=int(np.count_nonzero(better)))
+            if not better.any():
+                if record is not None:
+                    record.count(nodes_settled=int(np.isfinite(dist).sum()))
+                return
+            src_b,dst_b,cand = src[better],dst[better],cand[better]
+            np.minimum.at(dist,dst_b,cand)
+            won = cand == dist[dst_b]
+            pred[dst_b[won]] = src_b[won]
+        parents = {i:(p if p >= 0 else None) for i,p in 
+                   enumerate(pred.tolist())}
+        cycle = _parent_cycle(parents) or []
+        raise NegativeCycleError([self.labels[x] for x in cycle])
+
+    def scc(self):
+        '''strongly connected components as an int32 array of component
+        ids per node id, numbered in topological order of the condensation
+        (every edge stays in its component or goes to a later one).
+        Iterative Tarjan with an explicit stack of (node,next edge) frames,
+        so there is no recursion limit; cached
+        '''
+        if self.__scc is None:
+            V = len(self.labels)
+            indptr,indices = self.indptr.tolist(),self.indices.tolist()
+            order,low = [-1]*V,[0]*V
+            onstack = [False]*V
+            comp = [0]*V
+            stack,counter,ncomp = [],0,0
+            for root in range(V):
+                if order[root] >= 0:
+                    continue
+                order[root] = low[root] = counter
+                counter += 1
+                stack.append(root)
+                onstack[root] = True
+                frames = [(root,indptr[root])]
+                while frames:
+                    u,i = frames[-1]
+                    end = indptr[u+1]
+                    while i < end:
+                        v = indices[i]
+                        i += 1
+                        if order[v] < 0:
+                            frames[-1] = (u,i)
+                            order[v] = low[v] = counter
+                            counter += 1
+                            stack.append(v)
+                            onstack[v] = True
+                            frames.append((v,indptr[v]))
+                            break
+                        if onstack[v] and order[v] < low[u]:
+                            low[u] = order[v]
+                    else:
+                        frames.pop()
+                        if low[u] == order[u]: # u roots a component
+                            while True:
+                                x = stack.pop()
+                                onstack[x] = False
+                                comp[x] = ncomp
+                                if x == u:
+                                    break
+                            ncomp += 1
+                        if frames and low[u] < low[frames[-1][0]]:
+                            low[frames[-1][0]] = low[u]
+            # Tarjan completes sink components first
+            comp = (ncomp-1-np.array(comp,dtype=np.int64)).astype(np.int32)
+            members = np.argsort(comp,kind='stable')
+            bounds = np.searchsorted(comp[members],np.arange(ncomp+1))
+            self.__scc = (comp,members,bounds)
+        return self.__scc[0]
+
+    def sccpath(self,node_start,node_fin):
+        ''' shortest paths over the condensation DAG: components are visited
+            in topological order from node_start's onwards. A lone node is
+            settled by relaxing its out-edges as in dagpath; inside a cyclic
+            component a Dijkstra (SPFA if the component has a negative edge)
+            runs from the distances flowing into it. Only the cyclic parts
+            pay for a general search. Throws NegativeCycleError if a
+            component between node_start and the targets holds a negative
+            cycle
+        '''
+        comp = self.scc()
+        _,members,bounds = self.__scc
+        s = self.index[node_start]
+        targets = [self.index[x] for x in node_fin]
+        last = max(comp[targets].tolist())
+        comp,members,bounds = comp.tolist(),members.tolist(),bounds.tolist()
+        dist,pred = {s:0},{s:None}
+        for c in range(comp[s],last+1):
+            nodes = members[bounds[c]:bounds[c+1]]
+            seeds = [(u,dist[u]) for u in nodes if u in dist]
+            if not seeds:
+                continue
+            if _query.get() is not None:
+                _query.get().count(components=1)
+            inner = {u:[(v,w) for v,w in self._succ(u) if comp[v] == c] 
+                     for u in nodes}
+            if any(inner.values()):
+                # search from a virtual source -1 with an edge to each seed
+                succ = lambda u: seeds if u == -1 else inner[u]
+                if any(w < 0 for edges in inner.values() for _,w in edges):
+                    try:
+                        found,via = _spfa(succ,-1,len(nodes)+1)
+                    except NegativeCycleError as e:
+                        raise NegativeCycleError([self.labels[x] 
+                                                  for x in e.cycle])
+                else:
+                    found,via = _dijkstra(succ,-1)
+                for u,d in found.items():
+                    if u != -1 and via[u] != -1:
+                        dist[u],pred[u] = d,via[u]
+            for u in nodes:
+                if u not in dist:
+                    continue
+                for v,w in self._succ(u):
+                    if comp[v] != c and dist[u]+w < dist.get(v,np.inf):
+                        dist[v],pred[v] = dist[u]+w,u
+        return [(dist[t],[self.labels[x] for x in _trace(pred,t)]) 
+                if t in dist else (np.inf,[]) for t in targets]
+
+    def potentials(self):
+        '''Johnson potentials h (numpy array over node ids): shortest
+        distances from a virtual source joined to every node by a 0-weight
+        edge. w(u,v) + h[u] - h[v] >= 0 for every edge
+        '''
+        dist = np.zeros(len(self.labels))
+        self.__relax_passes(dist,np.full(len(self.labels),-1,dtype=np.int64))
+        if self.weights.dtype.kind in 'iu':
+            return dist.astype(np.int64)
+        return dist
+
+    def distance_matrix(self,sources,targets=None,workers=None,out=None):
+        '''dense matrix of shortest distances, M[i,j] from sources[i] to
+        targets[j] (every node if targets is None), inf where unreachable.
+        With negative edges the weights are made non-negative once with
+        Johnson's potentials, then every source runs an early-exit Dijkstra.
+        workers := None, a process count or an Executor to spread the
+        sources over a process pool; the CSR arrays and the result are
+        shared with the workers instead of being pickled
+        out := None for an in-memory array, or a .npy path to write a
+        memory-mapped result for source sets too big for RAM
+        '''
+        if targets is None:
+            targets = self.labels
+        s = np.array([self.index[x] for x in sources],dtype=np.int64)
+        t = np.array([self.index[x] for x in targets],dtype=np.int64)
+        weights = self.weights
+        h = np.zeros(len(self.labels),dtype=weights.dtype)
+        if self.min_weight() < 0:
+            h = self.potentials()
+            weights = weights+h[self.sources()]-h[self.indices]
+        shape = (len(s),len(t))
+        if out is None:
+            result = np.empty(shape,dtype=np.float64)
+        else:
+            result = np.lib.format.open_memmap(out,mode='w+',
+                                               dtype=np.float64,shape=shape)
+        executor,owned = _parallel.pool(workers)
+        if executor is None:
+            _distance_block(self.indptr,self.indices,weights,s,t,h,result)
+            return result
+        shared = [(None,None,('npy',self.__files[name],'r')) 
+                  if name in self.__files and array is getattr(self,name)
+                  else _parallel.shared_copy(array) for name,array in 
+                  zip(_CSR_ARRAYS,(self.indptr,self.indices,weights))]
+        if out is None:
+            shm_out,shared_out,outspec = _parallel.shared_copy(result)
+        else:
+            result.flush()
+            shm_out,shared_out,outspec = None,None,('npy',out)
+        try:
+            parts = _parallel.split_range(0,len(s),
+                                          4*_parallel.pool_size(workers))
+            futures = [executor.submit(_distance_worker,
+                                       [x[2] for x in shared],outspec,lo,hi,
+                                       s[lo:hi],t,h[s[lo:hi]],h[t])
+                       for lo,hi in parts]
+            for future in futures:
+                future.result()
+            if out is None:
+                result[...] = shared_out
+        finally:
+            if owned:
+                executor.shutdown()
+            del shared_out
+            for shm in [x[0] for x in shared]+[shm_out]:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+        return result
+
+    def min_weight(self):
+        return self.weights.min() if len(self.weights) else np.inf
+
+    def metric_scale(self,name):
+        '''see directed_graph.metric_scale'''
+        if name not in self.__metricscale:
+            labels = self.labels
+            self.__metricscale[name] = _metric_scale(_HEURISTICS[name],
+                ((labels[u],labels[v],w) for u,v,w in 
+                 zip(self.sources().tolist(),self.indices.tolist(),
+                     self.weights.tolist())))
+        return self.__metricscale[name]
+
+    def build_query_index(self):
+        '''contraction hierarchy for fast point-to-point queries, built
+        once (see directed_graph.build_query_index)
+        '''
+        if self.__chindex is None:
+            self.__chindex = contraction_hierarchy(self)
+        return self.__chindex
+
+    def reverse(self):
+        '''the transposed graph (every edge flipped) as a csr_graph sharing
+        the node ids, built once on demand
+        '''
+        if self.__reverse is None:
+            order = np.argsort(self.indices,kind='stable')
+            indptr = np.zeros(len(self.labels)+1,dtype=np.int64)
+            np.cumsum(np.bincount(self.indices,minlength=len(self.labels)),
+                      out=indptr[1:])
+            self.__reverse = csr_graph(self.labels,indptr,
+                                       self.sources()[order],
+                                       self.weights[order])
+        return self.__reverse
+
+    def shortest_path(self,node_start,node_fin,method='auto',heuristic=None):
+        ''' shortest path(s) from node_start to node_fin (a node or a list
+            of nodes), with the same methods as directed_graph.shortest_path
+        '''
+        if _stats_hook is None:
+            return self.__shortest_path(node_start,node_fin,method,heuristic)
+        cache = {'levels':self.__levels is not None,
+                 'scc':self.__scc is not None,
+                 'dfslog':self.__dfslog is not None,
+                 'chindex':self.__chindex is not None}
+        return _recorded(self,self.__shortest_path,cache,node_start,node_fin,
+                         method,heuristic)
+
+    def __shortest_path(self,node_start,node_fin,method,heuristic):
+        flag = False
+        if not isinstance(node_fin,list):
+            node_fin = [node_fin]
+            flag = True
+        record = _query.get()
+        if method == 'auto':
+            if record is not None:
+                start = time.perf_counter()
+            if self.__chindex is not None:
+                method = 'ch'
+            elif self.isdag():
+                method = 'dag'
+            elif self.ispositive():
+                method = 'dijkstra'
+            else:
+                method = 'scc'
+            if record is not None:
+                record.phase('dispatch',start)
+        if record is not None:
+            record.method = method
+        if method == 'ch':
+            result = [self.build_query_index().query(node_start,nf) 
+                      for nf in node_fin]
+        elif method == 'dag':
+            result = self.dagpath(node_start,node_fin)
+        elif method == 'dijkstra':
+            result = self.dijkstra(node_start,node_fin)
+        elif method == 'bellman_ford':
+            result = self.bellman_ford(node_start,node_fin)
+        elif method == 'spfa':
+            result = self.bellman_ford(node_start,node_fin,spfa=True)
+        elif method == 'scc':
+            result = self.sccpath(node_start,node_fin)
+        elif method in ('bidirectional','astar'):
+            result = _point_to_point(self,self.index[node_start],
+                                     [self.index[x] for x in node_fin],
+                                     method,heuristic,self._succ,
+                                     self.reverse()._succ,
+                                     self.labels.__getitem__)
+            result = [(d,[self.labels[x] for x in path]) 
+                      for d,path in result]
+        else:
+            raise Exception('unknown shortest path method ' + str(method))
+        if flag:
+            return result[0]
+        else:
+            return result
+
+
+class contraction_hierarchy:
+    '''Contraction hierarchy over a csr_graph with non-negative weights.
+    Nodes are contracted one at a time in order of edge difference (lazily
+    re-evaluated); contracting v adds a shortcut u->x for every pair of
+    remaining neighbours u->v->x unless a bounded witness search finds a
+    path at least as short around v. A query is then two Dijkstra searches
+    restricted to edges leading up the order, from the source along
+    out-edges and from the target along in-edges, and shortcuts are
+    unpacked through their middle node to give the full path.
+    '''
+
+    witness_settle_limit = 200 # nodes settled per witness search
+
+    def __init__(self,graph):
+        if graph.min_weight() < 0:
+            raise Exception('contraction hierarchies need non-negative weights')
+        self.labels,self.index = graph.labels,graph.index
+        V = len(self.labels)
+        out_adj,in_adj = [{} for _ in range(V)],[{} for _ in range(V)]
+        for u,v,w in zip(graph.sources().tolist(),graph.indices.tolist(),
+                         graph.weights.tolist()):
+            if u != v and w < out_adj[u].get(v,np.inf):
+                out_adj[u][v] = w
+                in_adj[v][u] = w
+        self.__middle = {} # (u,x) -> node bypassed by the shortcut u->x
+        self.__up = [None]*V # edges to nodes contracted later
+        self.__down = [None]*V # reversed in-edges from nodes contracted later
+        self.rank = [0]*V
+        deleted = [0]*V
+        heap = [(self.__priority(v,out_adj,in_adj,deleted),v) 
+                for v in range(V)]
+        heapq.heapify(heap)
+        order = 0
+        while heap:
+            _,v = heapq.heappop(heap)
+            priority = self.__priority(v,out_adj,in_adj,deleted)
+            if heap and priority > heap[0][0]: # lazy update
+                heapq.heappush(heap,(priority,v))
+                continue
+            for u,x,w in self.__shortcuts(v,out_adj,in_adj):
+                if w < out_adj[u].get(x,np.inf):
+                    out_adj[u][x] = w
+                    in_adj[x][u] = w
+                    self.__middle[(u,x)] = v
+            for u in in_adj[v]:
+                del out_adj[u][v]
+                deleted[u] += 1
+            for x in out_adj[v]:
+                del in_adj[x][v]
+                deleted[x] += 1
+            self.__up[v],self.__down[v] = out_adj[v],in_adj[v]
+            out_adj[v],in_adj[v] = {},{}
+            self.rank[v] = order
+            order += 1
+
+    def __witness(self,out_adj,source,skip,limit):
+        '''bounded Dijkstra from source avoiding skip, up to distance limit'''
+        dist = {source:0}
+        heap = [(0,source)]
+        settled = 0
+        while heap:
+            d,u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            settled += 1
+            if d > limit or settled > self.witness_settle_limit:
+                break
+            for v,w in out_adj[u].items():
+                if v != skip and d+w < dist.get(v,np.inf):
+                    dist[v] = d+w
+                    heapq.heappush(heap,(d+w,v))
+        return dist
+
+    def __shortcuts(self,v,out_adj,in_adj):
+        '''shortcuts (u,x,weight) needed to contract v'''
+        result = []
+        if not out_adj[v]:
+            return result
+        wmax = max(out_adj[v].values())
+        for u,w1 in in_adj[v].items():
+            dist = self.__witness(out_adj,u,v,w1+wmax)
+            for x,w2 in out_adj[v].items():
+                if x != u and dist.get(x,np.inf) > w1+w2:
+                    result.append((u,x,w1+w2))
+        return result
+
+    def __priority(self,v,out_adj,in_adj,deleted):
+        return len(self.__shortcuts(v,out_adj,in_adj)) - len(in_adj[v]) - \
+               len(out_adj[v]) + deleted[v]
+
+    def __upward(self,adjacency,root):
+        '''plain Dijkstra from root over the upward edges only'''
+        dist,pred = {root:0},{root:None}
+        heap = [(0,root)]
+        while heap:
+            d,u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for v,w in adjacency[u].items():
+                if d+w < dist.get(v,np.inf):
+                    dist[v],pred[v] = d+w,u
+                    heapq.heappush(heap,(d+w,v))
+        record = _query.get()
+        if record is not None:
+            record.count(nodes_settled=len(dist))
+        return dist,pred
+
+    def __unpack(self,u,x):
+        '''original nodes after u on the edge or shortcut u->x'''
+        path,stack = [],[(u,x)]
+        while stack:
+            a,b = stack.pop()
+            m = self.__middle.get((a,b))
+            if m is None:
+                path.append(b)
+            else:
+                stack.append((m,b))
+                stack.append((a,m))
+        return path
+
+    def query(self,node_start,node_fin):
+        '''(distance,path) from node_start to node_fin, (inf,[]) if there
+        is no path
+        '''
+        s,t = self.index[node_start],self.index[node_fin]
+        dist_f,pred_f = self.__upward(self.__up,s)
+        dist_b,pred_b = self.__upward(self.__down,t)
+        best,meet = np.inf,None
+        for x,d in dist_f.items():
+            if x in dist_b and d+dist_b[x] < best:
+                best,meet = d+dist_b[x],x
+        if meet is None:
+            return np.inf,[]
+        up = _trace(pred_f,meet)
+        path = [s]
+        for a,b in zip(up,up[1:]):
+            path.extend(self.__unpack(a,b))
+        x = meet
+        while pred_b[x] is not None:
+            path.extend(self.__unpack(x,pred_b[x]))
+            x = pred_b[x]
+        return best,[self.labels[i] for i in path]
@@ -4,9 +4,11 @@ Created on Tue Oct  4 22:53:41 2016
 
 @author: midhununnikrishnan
 """
+import itertools
+import math
 import numpy as np
-import combinatorics as cb
-        
+import _parallel
+
 def sumofdigits(G,k=1)->int:
     """find + of digits
     """
@@ -19,79 +21,374 @@ def sumofdigits(G,k=1)->int:
         G //=10
     return su    
  
-_mrpt_num_trials = 10 # number of bases to test
- 
-def is_probable_prime(n,numtrials=10):
+_SMALL_PRIMES = (2,3,5,7,11,13,17,19,23,29,31,37,41,43,47,53,59,61,67,71,
+                 73,79,83,89,97)
+
+# (bound, bases): Miller-Rabin with these bases is exact for all n < bound
+_MR_WITNESSES = ((2047,(2,)),
+                 (1373653,(2,3)),
+                 (25326001,(2,3,5)),
+                 (3215031751,(2,3,5,7)),
+                 (2152302898747,(2,3,5,7,11)),
+                 (3474749660383,(2,3,5,7,11,13)),
+                 (341550071728321,(2,3,5,7,11,13,17)),
+                 (3825123056546413051,(2,3,5,7,11,13,17,19,23)),
+                 (318665857834031151167461,(2,3,5,7,11,13,17,19,23,29,31,37)),
+                 (3317044064679887385961981,
+                  (2,3,5,7,11,13,17,19,23,29,31,37,41)))
+
+def _strong_probable_prime(n:int,a:int)->bool:
+    """single Miller-Rabin round: False means a witnesses that n is composite
     """
-    Miller-Rabin primality test. CODE PLAGIARIZED!!!! 
-    minor modification of the code in:
-    https://rosettacode.org/wiki/Miller%E2%80%93Rabin_primality_test#Python
- 
-    A return value of False means n is certainly not prime. A return value of
-    True means n is very likely a prime.
-     """
-    _mrpt_num_trials = numtrials
-    assert n >= 2
-    # special case 2,3
-    if n == 2 or n == 3:
+    d,s = n-1,0
+    while d%2 == 0:
+        d //= 2
+        s += 1
+    x = pow(a,d,n)
+    if x == 1 or x == n-1:
+        return True
+    for _ in range(s-1): # repeated squaring instead of fresh exponentiations
+        x = x*x%n
+        if x == n-1:
+            return True
+    return False
+
+def _jacobi(a:int,n:int)->int:
+    """Jacobi symbol (a/n) for odd positive n
+    """
+    a %= n
+    result = 1
+    while a:
+        while a%2 == 0:
+            a //= 2
+            if n%8 in (3,5):
+                result = -result
+        a,n = n,a
+        if a%4 == 3 and n%4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+def _strong_lucas_probable_prime(n:int)->bool:
+    """strong Lucas test with Selfridge's parameters, for odd n that is not
+       a perfect square
+    """
+    D = 5
+    while True:
+        j = _jacobi(D,n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D-2 if D > 0 else -D+2
+    P,Q = 1,(1-D)//4
+    d,s = n+1,0
+    while d%2 == 0:
+        d //= 2
+        s += 1
+    # U_k,V_k,Q^k by binary expansion of d, starting at k = 1
+    U,V,Qk = 1,P,Q%n
+    for bit in bin(d)[3:]:
+        U,V = U*V%n,(V*V-2*Qk)%n
+        Qk = Qk*Qk%n
+        if bit == '1':
+            U,V = P*U+V,D*U+P*V
+            if U%2: U += n
+            if V%2: V += n
+            U,V = (U//2)%n,(V//2)%n
+            Qk = Qk*Q%n
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s-1):
+        V = (V*V-2*Qk)%n
+        if V == 0:
+            return True
+        Qk = Qk*Qk%n
+    return False
+
+def is_probable_prime(n:int,numtrials:int=10)->bool:
+    """primality test: trial division by the primes below 100, then
+       Miller-Rabin with a deterministic witness set for n < 3.3e24 (the
+       answer is exact there) and Baillie-PSW for larger n (no known
+       counterexample). numtrials is kept for backwards compatibility, the
+       test no longer draws random bases.
+
+       A return value of False means n is certainly not prime. A return value of
+       True means n is very likely a prime.
+    """
+    n = int(n)
+    if n < 2:
+        return False
+    for p in _SMALL_PRIMES:
+        if n%p == 0:
+            return n == p
+    if n < 10201: # 101**2
         return True
-    # ensure n is odd
-    if n % 2 == 0:
+    for bound,bases in _MR_WITNESSES:
+        if n < bound:
+            return all(_strong_probable_prime(n,a) for a in bases)
+    if not _strong_probable_prime(n,2):
         return False
-    su = 0
-    t = n
-    while t>0:
-        su += t%10
-        t//=10
-    if su%3==0:
+    r = math.isqrt(n)
+    if r*r == n:
         return False
-    # write n-1 as 2**s * d
-    # repeatedly try to divide n-1 by 2
-    s = 0
-    d = n-1
+    return _strong_lucas_probable_prime(n)
+
+def _mulmod_small(a,b,n):
+    # n < 2**32 so the product fits in uint64
+    return a*b%n
+
+def _powmod_many(a,e,n,mulmod):
+    result = np.ones_like(n)
+    for k in range(int(e.max()).bit_length()):
+        bit = ((e >> np.uint64(k)) & np.uint64(1)).astype(bool)
+        if bit.any():
+            result = np.where(bit,mulmod(result,a,n),result)
+        a = mulmod(a,a,n)
+    return result
+
+def _miller_rabin_many(n,bases,mulmod):
+    """vectorized Miller-Rabin over a uint64 array of odd n; the bases are
+       applied only to the entries still believed prime
+    """
+    d,s = n-np.uint64(1),np.zeros(n.shape,dtype=np.int64)
     while True:
-        quotient, remainder = divmod(d, 2)
-        if remainder == 1:
+        even = (d & np.uint64(1)) == 0
+        if not even.any():
             break
-        s += 1
-        d = quotient
-    assert(2**s * d == n-1)
- 
-    # test the base a to see whether it is a witness for the compositeness of n
-    def try_composite(a):
-        if pow(a, d, n) == 1:
-            return False
-        for i in range(s):
-            if pow(a, 2**i * d, n) == n-1:
-                return False
-        return True # n is definitely composite
- 
-    for i in range(_mrpt_num_trials):
-        a = np.random.randint(2,n)
-        if try_composite(a):
-            return False
- 
-    return True # no base tested showed n as composite
+        d = np.where(even,d >> np.uint64(1),d)
+        s += even
+    alive = np.ones(n.shape,dtype=bool)
+    for a in bases:
+        idx = np.flatnonzero(alive)
+        if len(idx) == 0:
+            break
+        nn,ss = n[idx],s[idx]
+        aa = np.uint64(a)%nn
+        x = _powmod_many(aa,d[idx],nn,mulmod)
+        nm1 = nn-np.uint64(1)
+        ok = (aa == 0) | (x == 1) | (x == nm1)
+        for r in range(1,int(ss.max())):
+            pending = ~ok & (r < ss)
+            if not pending.any():
+                break
+            x = np.where(pending,mulmod(x,x,nn),x)
+            ok |= pending & (x == nm1)
+        alive[idx[~ok]] = False
+    return alive
+
+def _primality_worker(inspec,outspec,i:int,j:int):
+    shm_in,arr = _parallel.attach_array(inspec)
+    shm_out,out = _parallel.attach_array(outspec)
+    try:
+        out[i:j] = is_probable_prime_many(arr[i:j])
+    finally:
+        del arr,out
+        shm_in.close()
+        shm_out.close()
+
+def is_probable_prime_many(values,workers=None):
+    """is_probable_prime over an array of integers, returned as a boolean
+       array of the same shape. Inputs that fit in 64 bits are tested
+       together with numpy: trial division by the small primes, then
+       deterministic Miller-Rabin with bases (2,7,61) below 2**32. Anything
+       else (object arrays, n >= 2**32) falls back to the scalar test.
+       workers := None, a process count or an Executor; candidates and
+       results then live in shared memory and slices go to the pool.
+       Non-integer input (floats in particular) is rejected, not truncated
+    """
+    arr = np.asarray(values)
+    if not isinstance(values,np.ndarray) and arr.dtype.kind not in 'iu':
+        # e.g. negatives mixed with values >= 2**63 would become float64
+        arr = np.asarray(values,dtype=object)
+    if arr.dtype.kind not in 'iuO':
+        raise Exception('is_probable_prime_many needs integers, not ' + \
+                        str(arr.dtype))
+    executor,owned = _parallel.pool(workers)
+    if executor is not None:
+        try:
+            return _primality_parallel(arr,executor,workers)
+        finally:
+            if owned:
+                executor.shutdown()
+    if arr.dtype.kind not in 'iu':
+        flat = arr.ravel().tolist()
+        if not all(isinstance(x,int) for x in flat):
+            raise Exception('is_probable_prime_many needs integers')
+        flat = [is_probable_prime(x) for x in flat]
+        return np.array(flat,dtype=bool).reshape(arr.shape)
+    flat = arr.ravel()
+    result = np.zeros(flat.shape,dtype=bool)
+    positive = flat > 1
+    n = flat[positive].astype(np.uint64)
+    undecided = np.ones(n.shape,dtype=bool)
+    isp = np.zeros(n.shape,dtype=bool)
+    for p in _SMALL_PRIMES:
+        hit = undecided & (n%np.uint64(p) == 0)
+        isp[hit & (n == p)] = True
+        undecided &= ~hit
+    small = undecided & (n < 10201)
+    isp[small] = True
+    undecided &= ~small
+    idx = np.flatnonzero(undecided & (n < 2**32))
+    if len(idx):
+        isp[idx] = _miller_rabin_many(n[idx],(2,7,61),_mulmod_small)
+    # above 2**32 the products need 128 bits, where numpy cannot beat
+    # Python's own pow
+    undecided &= n >= 2**32
+    for i in np.flatnonzero(undecided).tolist():
+        isp[i] = is_probable_prime(int(n[i]))
+    result[positive] = isp
+    return result.reshape(arr.shape)
+
+def _primality_parallel(arr,executor,workers):
+    flat = arr.ravel()
+    parts = _parallel.split_range(0,len(flat),
+                                  4*_parallel.pool_size(workers))
+    if flat.dtype.kind not in 'iu': # object arrays cannot be shared
+        result = executor.map(is_probable_prime_many,
+                              [flat[i:j] for i,j in parts])
+        return np.concatenate([np.zeros(0,dtype=bool)]+list(result)).\
+               reshape(arr.shape)
+    shm_in,shared_in,inspec = _parallel.shared_array(flat.shape,
+                                                     flat.dtype)
+    shm_out,shared_out,outspec = _parallel.shared_array(flat.shape,bool)
+    try:
+        shared_in[:] = flat
+        futures = [executor.submit(_primality_worker,inspec,outspec,i,j)
+                   for i,j in parts]
+        for f in futures:
+            f.result()
+        return shared_out.reshape(arr.shape).copy()
+    finally:
+        del shared_in,shared_out
+        for shm in (shm_in,shm_out):
+            shm.close()
+            shm.unlink()
 
-def sieve(lessthan:int=-1,numprimes:int=-1):
-    """list of prime numbers using a simple Eratosthenes sieve
+_SEGMENT_ODDS = 1 << 18 # odd numbers per sieve segment: 256kB of uint8,
+                        # small enough to stay resident in L2 cache
+
+def _simple_sieve(lessthan:int):
+    """numpy array of the primes below lessthan, odd-only Eratosthenes.
+       Only meant for the small base primes (up to sqrt of the real limit)
+    """
+    if lessthan < 3:
+        return np.zeros(0,dtype=np.int64)
+    q = np.ones(lessthan//2,dtype=np.uint8) # q[i] <-> 2i+1
+    q[0] = 0
+    for i in range(1,(math.isqrt(lessthan-1)+1)//2):
+        if q[i]:
+            p = 2*i+1
+            q[p*p//2::p] = 0
+    primes = 2*np.flatnonzero(q).astype(np.int64)+1
+    return np.concatenate(([2],primes))
+
+def _sieve_segments(lo:int,hi:int=None,segsize:int=_SEGMENT_ODDS):
+    """generator of numpy arrays holding the primes in [lo,hi), one array per
+       segment. Only odd numbers are stored, composites are struck out by
+       slice assignment, and memory is bounded by segsize plus the base
+       primes up to sqrt(hi). hi = None sieves forever, growing the base
+       primes as the segments move up
+    """
+    lo = max(lo,2)
+    if hi is not None and lo >= hi:
+        return
+    if lo == 2:
+        yield np.array([2],dtype=np.int64)
+        lo = 3
+    lo |= 1 # first odd number >= lo
+    baselimit = 0 # base holds the odd primes below baselimit
+    seg = np.empty(segsize,dtype=np.uint8)
+    while hi is None or lo < hi:
+        segend = lo+2*segsize if hi is None else min(lo+2*segsize,hi)
+        root = math.isqrt(segend-1)
+        if root >= baselimit:
+            baselimit = root+1 if hi is not None else 2*root+1
+            base = _simple_sieve(baselimit)[1:]
+        buf = seg[:(segend-lo+1)//2] # buf[i] <-> lo+2i
+        buf.fill(1)
+        ps = base[:np.searchsorted(base,root,side='right')]
+        # first odd multiple of p in the segment, but no smaller than p*p
+        starts = -(-lo//ps)*ps
+        starts += ps*(starts%2 == 0)
+        starts = np.maximum(starts,ps*ps)
+        for p,s in zip(ps.tolist(),((starts-lo)//2).tolist()):
+            buf[s::p] = 0
+        yield lo+2*np.flatnonzero(buf)
+        lo += 2*segsize
+
+def primes_iter(start:int=2,stop:int=None,chunked:bool=False,
+                segsize:int=_SEGMENT_ODDS):
+    """lazy generator of the primes p with start <= p < stop, in increasing
+       order. stop = None never terminates, so the caller decides when to
+       stop walking. With chunked = True whole segments are yielded as int64
+       numpy arrays instead of single ints.
+       Memory is bounded by segsize (odd numbers per segment) and the base
+       primes up to sqrt of the current position, never by stop itself
+    """
+    for chunk in _sieve_segments(start,stop,segsize):
+        if chunked:
+            if len(chunk):
+                yield chunk
+        else:
+            yield from chunk.tolist()
+
+def _nth_prime_bound(n:int)->int:
+    """strict upper bound on the n-th prime (Rosser's theorem for n >= 6)
+    """
+    if n < 6:
+        return 13
+    return int(n*(math.log(n)+math.log(math.log(n))))+1
+
+def _sieve_range(lo:int,hi:int):
+    return np.concatenate([np.zeros(0,dtype=np.int64)]+
+                          list(_sieve_segments(lo,hi)))
+
+def _primes_between(lo:int,hi:int,workers=None):
+    """int64 array of the primes in [lo,hi), sieved segment-aligned ranges
+       at a time on a process pool if workers is given
+    """
+    executor,owned = _parallel.pool(workers)
+    if executor is None:
+        return _sieve_range(lo,hi)
+    try:
+        parts = _parallel.split_range(lo,hi,4*_parallel.pool_size(workers),
+                                      2*_SEGMENT_ODDS)
+        chunks = list(executor.map(_sieve_range,*zip(*parts)))
+    finally:
+        if owned:
+            executor.shutdown()
+    return np.concatenate([np.zeros(0,dtype=np.int64)]+chunks)
+
+def sieve(lessthan:int=-1,numprimes:int=-1,asarray:bool=False,workers=None):
+    """list of prime numbers using a segmented Eratosthenes sieve
        numprimes := the number of consecutive primes from 2 to be computed
        lessthan := strict upper bound on the largest prime to be computed
        If both numprimes and lessthan are specified, lessthan is given
        precedence
+       asarray := return an int64 numpy array instead of a list, which is
+       far more compact for large limits
+       workers := None, a process count or an Executor to sieve disjoint
+       ranges in parallel
     """
     if numprimes < 1 and lessthan < 3:
         raise Exception('invalid specifications')
     if lessthan > 1e18: # your computer can easily crash for less
         raise Exception('are you trying to crash your computer?') 
-        
-    q = np.zeros(lessthan+1)
-    for j in range(2,(lessthan+1)//2):
-        if q[j] == 0:
-            for k in range(2,1+(lessthan-1)//j):
-                q[int(k*j)] = 1
-    primes = [x for x in range(2,lessthan) if q[x]==0]
-    return primes
+
+    if lessthan >= 3:
+        primes = _primes_between(2,lessthan,workers)
+    else:
+        # sieve up to a bound on the numprimes-th prime, extending the
+        # range in case the estimate ever falls short
+        chunks,count,lo,hi = [],0,2,_nth_prime_bound(numprimes)
+        while count < numprimes:
+            chunks.append(_primes_between(lo,hi,workers))
+            count += len(chunks[-1])
+            lo,hi = hi,2*hi
+        primes = np.concatenate(chunks)[:numprimes]
+    return primes if asarray else primes.tolist()
 
 def isprime(N:int)->bool:
     """primality test
@@ -101,42 +398,214 @@ def isprime(N:int)->bool:
     else:
         return False
 
-def PrimeFactors(N):
-    d = 2
-    factors = []
-    while N > 1:
-        if N % d == 0:
-            i=0
-            while N % d == 0:
-                N /= d
-                i+=1
-            factors.append((d,i))
-        d+=1
+_TRIAL_PRIMES = _simple_sieve(1 << 12).tolist()
+_ECM_MIN_BITS = 80 # cofactors this large go to ECM first when ecm=True
+
+def _pollard_brent(n:int)->int:
+    """a nontrivial factor of the odd composite n by Brent's variant of
+       Pollard rho. |x-y| is accumulated over blocks of m steps so that only
+       one gcd is taken per block; on overshoot the last block is replayed
+       step by step. The polynomial constant c is bumped deterministically
+       if a cycle closes without splitting n
+    """
+    m = 128
+    for c in itertools.count(1):
+        y,r,q,g = 2,1,1,1
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y*y+c)%n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(m,r-k)):
+                    y = (y*y+c)%n
+                    q = q*abs(x-y)%n
+                g = math.gcd(q,n)
+                k += m
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys*ys+c)%n
+                g = math.gcd(abs(x-ys),n)
+        if g != n:
+            return g
+
+def _iroot(n:int,k:int)->int:
+    """floor of the k-th root of n >= 0, by integer Newton iteration from
+       a power of two above the root
+    """
+    if k == 2 or n < 2:
+        return math.isqrt(n)
+    x = 1 << -(-n.bit_length()//k)
+    while True:
+        y = ((k-1)*x+n//x**(k-1))//k
+        if y >= x:
+            return x
+        x = y
+
+def _perfect_power(n:int):
+    """(root,k) with root**k == n for a prime k, or None. Only called on
+       cofactors free of the trial primes, whose prime factors all exceed
+       2**12, which bounds k by n.bit_length()//12
+    """
+    for k in _TRIAL_PRIMES:
+        if k > n.bit_length()//12:
+            break
+        root = _iroot(n,k)
+        if root**k == n:
+            return root,k
+    return None
+
+def _ecm(n:int,B1:int=10000,curves:int=40):
+    """stage-1 Lenstra ECM on Montgomery curves (Suyama's parametrization),
+       returns a nontrivial factor of n or None if every curve fails
+    """
+    def xdbl(x,z):
+        s,d = (x+z)*(x+z)%n,(x-z)*(x-z)%n
+        t = s-d
+        return s*d%n,t*(d+a24*t)%n
+    def xadd(x1,z1,x2,z2,xd,zd): # P1+P2 given P1-P2
+        u,v = (x1-z1)*(x2+z2),(x1+z1)*(x2-z2)
+        return zd*(u+v)*(u+v)%n,xd*(u-v)*(u-v)%n
+
+    for sigma in range(6,6+curves):
+        u,v = (sigma*sigma-5)%n,4*sigma%n
+        x,z = pow(u,3,n),pow(v,3,n)
+        num,den = pow(v-u,3,n)*(3*u+v)%n,16*x*v%n
+        g = math.gcd(den,n)
+        if g == n:
+            continue
+        if g > 1:
+            return g
+        a24 = num*pow(den,-1,n)%n # (A+2)/4
+        for p in primes_iter(2,B1+1):
+            pk = p
+            while pk*p <= B1:
+                pk *= p
+            # Montgomery ladder for pk*(x:z)
+            x0,z0 = x,z
+            x1,z1 = xdbl(x,z)
+            for bit in bin(pk)[3:]:
+                if bit == '1':
+                    x0,z0 = xadd(x1,z1,x0,z0,x,z)
+                    x1,z1 = xdbl(x1,z1)
+                else:
+                    x1,z1 = xadd(x0,z0,x1,z1,x,z)
+                    x0,z0 = xdbl(x0,z0)
+            x,z = x0,z0
+        g = math.gcd(z,n)
+        if 1 < g < n:
+            return g
+    return None
+
+def PrimeFactors(N:int,ecm:bool=False):
+    """prime factorization of N as a sorted list of (prime,exponent) pairs
+       with exact integers throughout. Trial division by the sieved primes
+       below 4096 comes first, then whatever is left is split by
+       Pollard-Brent rho (with ECM tried first on cofactors above 80 bits
+       if ecm = True) until every part passes is_probable_prime. Perfect
+       powers are reduced to their root before any splitting
+    """
+    N = int(N)
+    factors = {}
+    for d in _TRIAL_PRIMES:
         if d*d > N:
-            if N > 1:
-                factors.append((int(N),1))
             break
-    return factors
+        if N%d == 0:
+            i = 0
+            while N%d == 0:
+                N //= d
+                i += 1
+            factors[d] = i
+    stack = [(N,1)] if N > 1 else [] # (cofactor,multiplicity)
+    while stack:
+        n,e = stack.pop()
+        if is_probable_prime(n):
+            factors[n] = factors.get(n,0)+e
+            continue
+        power = _perfect_power(n) # rho would need ~sqrt(p) steps on p**k
+        if power is not None:
+            stack.append((power[0],e*power[1]))
+            continue
+        d = None
+        if ecm and n.bit_length() >= _ECM_MIN_BITS:
+            d = _ecm(n)
+        if d is None:
+            d = _pollard_brent(n)
+        stack.extend(((d,e),(n//d,e)))
+    return sorted(factors.items())
     
+def PrimeFactors_many(values,ecm:bool=False,workers=None):
+    """PrimeFactors for every integer in values, as a list of factor lists.
+       workers := None, a process count or an Executor to factor the
+       integers on a process pool
+    """
+    values = [int(x) for x in values]
+    executor,owned = _parallel.pool(workers)
+    if executor is None:
+        return [PrimeFactors(x,ecm) for x in values]
+    try:
+        chunk = max(1,len(values)//(8*_parallel.pool_size(workers)))
+        return list(executor.map(PrimeFactors,values,
+                                 itertools.repeat(ecm),chunksize=chunk))
+    finally:
+        if owned:
+            executor.shutdown()
+
+def _spf_table(N:int):
+    """smallest-prime-factor table for 0 <= n < N as an int32 array (int64
+       once N passes 2**31), with spf[p] = p for primes and spf[0],spf[1] =
+       0,1. Built in one sieve pass over the base primes taken in
+       decreasing order, so the smallest prime is the one left standing
+    """
+    dtype = np.int32 if N <= np.iinfo(np.int32).max else np.int64
+    spf = np.zeros(N,dtype=dtype)
+    for p in reversed(_simple_sieve(math.isqrt(max(N-1,0))+1).tolist()):
+        spf[p*p::p] = p
+    untouched = np.flatnonzero(spf == 0)
+    spf[untouched] = untouched
+    return spf
+
 class assistedPF:
     """ facility to efficiently factorize where multiple factorizations
-        require to be done in sequence
+        require to be done in sequence.
+        With spf = True (default) a smallest-prime-factor table of 4 bytes
+        per integer below N is kept and every factorization is O(log N)
+        lookups; spf = False keeps the older mode that walks the prime list
     """
        
     __Numprimes = 10
     __sieve = []
     __nbool = []
-    def __init__(self,N):
+    __spf = None
+    def __init__(self,N,spf:bool=True):
         self.__Numprimes = N
-        self.__sieve = sieve(N)
-        self.__nbool = [False]*N
-        for i in self.__sieve:
-            self.__nbool[i] = True
+        if spf:
+            self.__spf = _spf_table(N)
+        else:
+            self.__sieve = sieve(N)
+            self.__nbool = np.zeros(N,dtype=bool)
+            self.__nbool[self.__sieve] = True
 
     def factorize(self,N):    
         """ factorize w.r.t the primes constructed - prime factors p for
             p > N are not captured
         """
+        if self.__spf is not None:
+            if not 0 < N < self.__Numprimes:
+                raise Exception('can only factorize 0 < N < table size')
+            spf = self.__spf
+            pfs = []
+            while N > 1:
+                d = int(spf[N])
+                i = 0
+                while N%d == 0:
+                    i += 1
+                    N //= d
+                pfs.append((d,i))
+            return pfs
         pfs = []
         if self.__nbool[N]:
             return [(N,1)]
@@ -150,6 +619,45 @@ class assistedPF:
             if d > N:
                 break
         return pfs
+
+    def factorize_many(self,values,asarrays:bool=False):
+        """ factorize a whole array of integers 0 < n < N at once. All
+            entries are divided by their smallest prime factor in lockstep,
+            so there are at most log2(N) numpy passes.
+            Returns a list of factorize() style lists, or with asarrays =
+            True the CSR-like triple (indptr,primes,exponents) where the
+            factors of values[i] are primes[indptr[i]:indptr[i+1]]
+        """
+        n = np.asarray(values,dtype=np.int64).ravel()
+        if self.__spf is None:
+            return [self.factorize(int(x)) for x in n]
+        if len(n) and (n.min() < 1 or n.max() >= self.__Numprimes):
+            raise Exception('can only factorize 0 < N < table size')
+        spf = self.__spf
+        rem = n.copy()
+        rows,primes = [np.zeros(0,dtype=np.int64)],[np.zeros(0,dtype=np.int64)]
+        live = np.flatnonzero(rem > 1)
+        while len(live):
+            p = spf[rem[live]].astype(np.int64)
+            rows.append(live)
+            primes.append(p)
+            rem[live] //= p
+            live = live[rem[live] > 1]
+        rows,primes = np.concatenate(rows),np.concatenate(primes)
+        # stable sort by row keeps each row's primes in nondecreasing order
+        order = np.argsort(rows,kind='stable')
+        rows,primes = rows[order],primes[order]
+        first = np.ones(len(rows),dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (primes[1:] != primes[:-1])
+        starts = np.flatnonzero(first)
+        exps = np.diff(np.append(starts,len(rows)))
+        rows,primes = rows[starts],primes[starts]
+        indptr = np.searchsorted(rows,np.arange(len(n)+1))
+        if asarrays:
+            return indptr,primes,exps
+        primes,exps = primes.tolist(),exps.tolist()
+        return [list(zip(primes[i:j],exps[i:j])) 
+                for i,j in zip(indptr[:-1].tolist(),indptr[1:].tolist())]
         
 def factorcombine(factors):
     prod = 1
@@ -166,58 +674,354 @@ def sumofFactors(N:int)->int:
         prod *= (q[0]**(q[1]+1)-1)//(q[0]-1)
     return prod-N
     
+_ARITH_FUNCS = ('sigma','phi','mu','tau','omega')
+_ARITH_DTYPES = {'sigma':np.int64,'phi':np.int64,'mu':np.int8,
+                 'tau':np.int32,'omega':np.uint8}
+_ARITH_SEGMENT = 1 << 20 # integers per segment of the table sieve
+
+def _arith_segment(lo:int,hi:int,which,base,out:dict):
+    """fill out[f][0:hi-lo] with f(n) for lo <= n < hi and every f in which.
+       base must hold the primes p with p*p < hi. Each prime power p^k
+       strikes its multiples by slice assignment, patching the factors it
+       contributes; whatever is left in rem afterwards is 1 or the single
+       prime factor above sqrt(hi)
+    """
+    rem = np.arange(lo,hi,dtype=np.int64)
+    sigma,phi,mu,tau,omega = [out.get(f) for f in _ARITH_FUNCS]
+    for f,arr in out.items():
+        arr[...] = 0 if f == 'omega' else 1
+    if phi is not None:
+        phi[...] = rem
+    for p in base.tolist():
+        pk,k,S = p,1,1 # S = 1+p+...+p^(k-1)
+        while pk < hi:
+            s = max(-(-lo//pk)*pk,pk)-lo
+            rem[s::pk] //= p
+            Snew = S*p+1
+            if k == 1:
+                if phi is not None:
+                    phi[s::p] -= phi[s::p]//p
+                if mu is not None:
+                    mu[s::p] *= -1
+                if omega is not None:
+                    omega[s::p] += 1
+            elif mu is not None:
+                mu[s::pk] = 0
+            if tau is not None: # the factor k from p^(k-1) becomes k+1
+                tau[s::pk] //= k
+                tau[s::pk] *= k+1
+            if sigma is not None:
+                sigma[s::pk] //= S
+                sigma[s::pk] *= Snew
+            pk,k,S = pk*p,k+1,Snew
+    big = np.flatnonzero(rem > 1)
+    q = rem[big]
+    if sigma is not None:
+        sigma[big] *= q+1
+    if phi is not None:
+        phi[big] -= phi[big]//q
+    if mu is not None:
+        mu[big] *= -1
+    if tau is not None:
+        tau[big] *= 2
+    if omega is not None:
+        omega[big] += 1
+    if lo == 0:
+        for arr in out.values():
+            arr[0] = 0
+
+def arithmetic_tables_iter(lo:int,hi:int,which=_ARITH_FUNCS,
+                           segsize:int=_ARITH_SEGMENT):
+    """generator over consecutive segments of [lo,hi) yielding (start,tables)
+       where tables[f][i] = f(start+i) for each requested arithmetic
+       function f. Memory is bounded by segsize, so ranges far beyond RAM
+       can be streamed. The functions are
+           sigma := sum of all divisors (sumofFactors(n) = sigma(n) - n)
+           phi := Euler's totient
+           mu := Moebius function
+           tau := number of divisors
+           omega := number of distinct prime factors
+       All tables are 0 at n = 0
+    """
+    which = tuple(which)
+    for f in which:
+        if f not in _ARITH_FUNCS:
+            raise Exception('unknown arithmetic function ' + str(f))
+    lo = max(lo,0)
+    if lo >= hi:
+        return
+    base = _simple_sieve(math.isqrt(hi-1)+1)
+    for start in range(lo,hi,segsize):
+        end = min(start+segsize,hi)
+        tables = {f:np.empty(end-start,dtype=_ARITH_DTYPES[f]) for f in which}
+        _arith_segment(start,end,which,
+                       base[:np.searchsorted(base,math.isqrt(end-1),'right')],
+                       tables)
+        yield start,tables
+
+def _arith_worker(lo:int,hi:int,which,specs:dict):
+    attached = {f:_parallel.attach_array(spec)
+                for f,spec in specs.items()}
+    try:
+        for start,chunk in arithmetic_tables_iter(lo,hi,which):
+            for f in which:
+                attached[f][1][start:start+len(chunk[f])] = chunk[f]
+    finally:
+        for f in list(attached):
+            shm = attached.pop(f)[0]
+            shm.close()
+
+def arithmetic_tables(N:int,which=_ARITH_FUNCS,workers=None)->dict:
+    """numpy arrays of arithmetic functions for all 0 <= n <= N computed in
+       one sieve pass, as a dict keyed by function name - see
+       arithmetic_tables_iter for the names. The table is filled segment by
+       segment so the working set stays in cache.
+       workers := None, a process count or an Executor; segments are then
+       sieved on the pool straight into shared memory tables
+    """
+    which = tuple(which)
+    executor,owned = _parallel.pool(workers)
+    if executor is None:
+        tables = {f:np.empty(N+1,dtype=_ARITH_DTYPES[f]) for f in which}
+        for start,chunk in arithmetic_tables_iter(0,N+1,which):
+            for f in which:
+                tables[f][start:start+len(chunk[f])] = chunk[f]
+        return tables
+    shared = {f:_parallel.shared_array((N+1,),_ARITH_DTYPES[f])
+              for f in which}
+    try:
+        specs = {f:s[2] for f,s in shared.items()}
+        parts = _parallel.split_range(0,N+1,4*_parallel.pool_size(workers),
+                                      _ARITH_SEGMENT)
+        futures = [executor.submit(_arith_worker,lo,hi,which,specs)
+                   for lo,hi in parts]
+        for future in futures:
+            future.result()
+        return {f:s[1].copy() for f,s in shared.items()}
+    finally:
+        if owned:
+            executor.shutdown()
+        for f in list(shared):
+            shm = shared.pop(f)[0]
+            shm.close()
+            shm.unlink()
+
 def gcd(a:int,b:int)->int:
-    """ Euclid's algorithm for GCD of two integers
+    """ GCD of two integers, always >= 0 with gcd(0,0) = 0. math.gcd is
+        Lehmer's algorithm in C (binary GCD on small operands), so it beats
+        any pure Python loop for both machine-sized and huge integers
     """
-    if a<=0 or b<=0:
-        raise Exception('only positive integers as input to gcd')
-    while True:
-        if a==b:
-        
-            return a
-        elif b==1 or a==1:
-            return 1
-        elif a>b:
-            b = a-b
-            a = a-b
-        else:
-            b = b-a
-            a = b+a
+    return math.gcd(int(a),int(b))
+
+def egcd(a:int,b:int):
+    """ extended Euclid: (g,x,y) with a*x + b*y = g = gcd(a,b)
+    """
+    a,b = int(a),int(b)
+    x0,y0,x1,y1 = 1,0,0,1
+    while b:
+        q,r = divmod(a,b)
+        a,b = b,r
+        x0,x1 = x1,x0-q*x1
+        y0,y1 = y1,y0-q*y1
+    if a < 0:
+        return -a,-x0,-y0
+    return a,x0,y0
+
+def modinv(a:int,m:int)->int:
+    """ inverse of a modulo m, in the range [0,m)
+    """
+    g,x,_ = egcd(a,m)
+    if g != 1:
+        raise Exception('a is not invertible modulo m')
+    return x%abs(m)
+
+def gcd_many(a,b):
+    """ elementwise gcd of two integer arrays (broadcast as usual), using
+        numpy's compiled Euclid loop
+    """
+    return np.gcd(np.asarray(a,dtype=np.int64),np.asarray(b,dtype=np.int64))
 
-def coprime(N):
+def lcm_reduce(values)->int:
+    """ lcm of all the integers in values (1 for none). The array is folded
+        in halves with numpy while the result provably fits in int64, and
+        finished with exact Python integers once it might not
+    """
+    arr = np.abs(np.asarray(values,dtype=np.int64).ravel())
+    if len(arr) and arr.min() == 0:
+        return 0
+    limit = np.iinfo(np.int64).max
+    while len(arr) > 1:
+        half = len(arr)//2
+        x,y = arr[:half],arr[half:2*half]
+        q = x//np.gcd(x,y)
+        if (q > limit//y).any():
+            break
+        arr = np.concatenate((q*y,arr[2*half:]))
+    result = 1
+    for x in arr.tolist():
+        result = result//math.gcd(result,x)*x
+    return result
+
+_COPRIME_BLOCK = 1 << 16 # products factored together by coprime()
+
+def _prime_power_block(lo:int,hi:int,base):
+    """prime-power decomposition of every lo <= n < hi (lo >= 1) as
+       (pp,counts): pp[i,:counts[i]] are the maximal prime powers dividing
+       lo+i in increasing order of the prime, the rest of the row is 1.
+       base must hold the primes p with p*p < hi
+    """
+    width,prod = 1,2 # most distinct primes an n < hi can have
+    for p in _SMALL_PRIMES[1:]:
+        prod *= p
+        if prod >= hi:
+            break
+        width += 1
+    size = hi-lo
+    pp = np.ones((size,width),dtype=np.int64)
+    counts = np.zeros(size,dtype=np.int64)
+    rem = np.arange(lo,hi,dtype=np.int64)
+    for p in base.tolist():
+        idx = np.arange(max(-(-lo//p)*p,p)-lo,size,p)
+        if len(idx) == 0:
+            continue
+        rem[idx] //= p
+        power = np.full(len(idx),p,dtype=np.int64)
+        more = np.arange(len(idx))
+        while True:
+            more = more[rem[idx[more]]%p == 0]
+            if len(more) == 0:
+                break
+            rem[idx[more]] //= p
+            power[more] *= p
+        pp[idx,counts[idx]] = power
+        counts[idx] += 1
+    big = np.flatnonzero(rem > 1) # the one prime factor above sqrt(hi)
+    pp[big,counts[big]] = rem[big]
+    counts[big] += 1
+    return pp,counts
+
+def _coprime_block_arrays(lo:int,pp,counts):
+    """all (f1,f2) splits of the products in a _prime_power_block, as two
+       int64 arrays ordered by product
+    """
+    n = lo+np.arange(len(counts),dtype=np.int64)
+    f1s,keys = [],[]
+    for k in np.unique(counts).tolist():
+        rows = np.flatnonzero(counts == k)
+        # masks[j,b] = bit b of j, picking which prime powers go to f1
+        masks = (np.arange(1 << k)[:,None] >> np.arange(k)) & 1 == 1
+        f1s.append(np.where(masks,pp[rows,None,:k],1).prod(axis=2).ravel())
+        keys.append(np.repeat(rows,1 << k))
+    order = np.argsort(np.concatenate(keys),kind='stable')
+    f1 = np.concatenate(f1s)[order]
+    return f1,n[np.concatenate(keys)[order]]//f1
+
+def coprime(N,chunked:bool=False):
     """ Cheap generator to iterate across all coprime pairs of integers
         ordered by the product of the pair.
         Generates only pairs comprised of numbers whose product is below N.
+        Products are factored a block at a time by a segmented sieve, so
+        memory is O(sqrt(N) + block) however far the generator runs. The
+        2^omega(n) splits of each product n come in Gray-code order, so
+        every pair after the first costs one multiply and one divide.
+        With chunked = True each block is yielded as a pair of int64 numpy
+        arrays (f1,f2) instead.
     """ 
-    F = assistedPF(N)
-    for i in range(1,N):
-        P = F.factorize(i)
-        for j in range(2**len(P)):
-            bits = cb.int2list(2**len(P)+j,2)[1:]
-            f1 = factorcombine([P[x] for x in range(len(P)) if bits[x]==0])
-            f2 = factorcombine([P[x] for x in range(len(P)) if bits[x]==1])
+    if N < 2:
+        return
+    base = _simple_sieve(math.isqrt(N-1)+1)
+    for lo in range(1,N,_COPRIME_BLOCK):
+        hi = min(lo+_COPRIME_BLOCK,N)
+        pp,counts = _prime_power_block(
+            lo,hi,base[:np.searchsorted(base,math.isqrt(hi-1),'right')])
+        if chunked:
+            yield _coprime_block_arrays(lo,pp,counts)
+            continue
+        for n,k,q in zip(range(lo,hi),counts.tolist(),pp.tolist()):
+            f1,f2 = 1,n
             yield (f1,f2)
+            in_f1 = [False]*k
+            for j in range(1,1 << k):
+                b = (j & -j).bit_length()-1 # the one bit flipped in Gray code
+                if in_f1[b]:
+                    f1,f2 = f1//q[b],f2*q[b]
+                else:
+                    f1,f2 = f1*q[b],f2//q[b]
+                in_f1[b] = not in_f1[b]
+                yield (f1,f2)
         
 
 def sqrtiter(N):
-    """ generates an infinite iterator for the continued fraction 
+    r""" generates an infinite iterator for the continued fraction 
         coefficients of \sqrt{N}. i.e., ${a_0,a_1,a_2...}$ is yielded
         by this iterator where
         \sqrt{N} = a_0 + \frac{1}{a_1 + \frac{1}{a_2 + \dots}}
+        Everything is exact integer arithmetic on the triple (m,d,a) with
+        \sqrt{N} tails (m + \sqrt{N})/d, so memory stays constant. For a
+        perfect square the expansion stops after a_0
     """
-    b,c = 0,1
-    sqrt = np.sqrt(N)
-    if int(sqrt)==sqrt:
-        return 0
-    history = []
-    a = int((b+sqrt)/c)
-    yield a
+    a0 = math.isqrt(N)
+    yield a0
+    if a0*a0 == N:
+        return
+    m,d,a = 0,1,a0
     while True:
-        history.append((a,b,c))
-        b = c*a - b
-        c = (N - b**2)/c
-        assert int(c) == c
-        assert c>0
-        a = int((b+sqrt)/c)
+        m = d*a-m
+        d = (N-m*m)//d
+        a = (a0+m)//d
         yield a
 
+def sqrt_period(N):
+    """ (a_0,period) for the continued fraction of sqrt(N), where period is
+        the tuple of repeating coefficients - empty for perfect squares.
+        The period ends at the first a_k = 2 a_0, so this is O(period)
+    """
+    it = sqrtiter(N)
+    a0 = next(it)
+    period = []
+    for a in it:
+        period.append(a)
+        if a == 2*a0:
+            break
+    return a0,tuple(period)
+
+def sqrt_convergents(N):
+    """ generator of the convergents (p_k,q_k) of sqrt(N), i.e. p_k/q_k is
+        the continued fraction truncated after a_k. Only the previous two
+        convergents are kept
+    """
+    p0,q0,p1,q1 = 1,0,0,1 # (p_{k-1},q_{k-1}),(p_{k-2},q_{k-2})
+    for a in sqrtiter(N):
+        p0,q0,p1,q1 = a*p0+p1,a*q0+q1,p0,q0
+        yield p0,q0
+
+def pell(N,negative:bool=False):
+    """ fundamental solution (x,y) of x^2 - N y^2 = 1, or of
+        x^2 - N y^2 = -1 with negative = True. Read off the convergent
+        (p_{r-1},q_{r-1}) at the end of the first period r, which solves the
+        equation with right hand side (-1)^r
+    """
+    if math.isqrt(N)**2 == N:
+        raise Exception('Pell equation needs a non-square N')
+    # p_k^2 - N q_k^2 = (-1)^(k+1) d_{k+1}, and d_{k+1} = 1 first at k = r-1
+    for k,(p,q) in enumerate(sqrt_convergents(N)):
+        if abs(p*p-N*q*q) == 1:
+            break
+    r = k+1
+    if negative:
+        if r%2 == 0:
+            raise Exception('x^2 - N y^2 = -1 has no solution for this N')
+        return p,q
+    if r%2:
+        return p*p+N*q*q,2*p*q
+    return p,q
+
+def pell_iter(N):
+    """ generator of all positive solutions of x^2 - N y^2 = 1 in increasing
+        order, as powers of the fundamental solution
+    """
+    x1,y1 = pell(N)
+    x,y = x1,y1
+    while True:
+        yield x,y
+        x,y = x1*x+N*y1*y,x1*y+y1*x